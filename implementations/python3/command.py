@@ -0,0 +1,88 @@
+#!/usr/bin/env python3.9
+# The commands in this directory are symlinks to this file. If the
+# HINTFUL_DIFF_SERVER_SOCKET environment variable names the socket of a server
+# started with `implementation.py --serve SOCKET`, the command is run by that
+# server. Otherwise, or if no server answers, it is run in this process. This
+# file is kept small and imports little, since it is compiled on every run.
+import os, socket, struct, sys, threading
+
+frameHeader = struct.Struct('>cI')
+
+def connect():
+    path=os.environ.get('HINTFUL_DIFF_SERVER_SOCKET')
+    if not path:
+        return None
+    sock=socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def sendRequest(sock, command, f):
+    # Runs in its own thread, so that output can be received while the diff is
+    # still being sent.
+    try:
+        sock.sendall(f"{command} {int(sys.stdout.isatty())}\n".encode('latin1'))
+        while True:
+            block=f.read1(1<<20)
+            if not block:
+                break
+            sock.sendall(block)
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        # The server stopped reading, e.g. because the diff is invalid. The
+        # reason is in the frames it sent.
+        pass
+
+def receiveResponse(sock):
+    rfile=sock.makefile('rb')
+    while True:
+        header=rfile.read(frameHeader.size)
+        if(len(header)<frameHeader.size):
+            sys.stderr.write("Connection to server lost\n")
+            return 2
+        [kind, length]=frameHeader.unpack(header)
+        data=rfile.read(length)
+        if(kind==b'o'):
+            sys.stdout.buffer.write(data)
+        elif(kind==b'e'):
+            sys.stderr.buffer.write(data)
+        elif(kind==b'x'):
+            return data[0]
+
+def runOnServer(command, args):
+    # Options are left to the in-process argument parser. Commands that work on
+    # files of the client, like applying, generating and indexing diffs, and
+    # commands that are not built from a processing stack are run in process,
+    # as are profiled runs and runs using a validation cache.
+    if(command.startswith(('apply-', 'diff-', 'diffstat-', 'index-', 'extract-')) or 1<len(args) or any(arg.startswith('-') for arg in args)
+       or os.environ.get('HINTFUL_DIFF_PROFILE') or os.environ.get('HINTFUL_DIFF_CACHE')):
+        return None
+    sock=connect()
+    if not sock:
+        return None
+    try:
+        f=open(args[0], 'rb') if args else sys.stdin.buffer
+    except OSError:
+        sock.close()
+        return None
+    with sock, f:
+        sender=threading.Thread(target=sendRequest, args=(sock, command, f), daemon=True)
+        sender.start()
+        try:
+            status=receiveResponse(sock)
+            sys.stdout.buffer.flush()
+        except BrokenPipeError:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            status=1
+    return status
+
+if __name__ == "__main__":
+    status=runOnServer(os.path.basename(sys.argv[0]), sys.argv[1:])
+    if(status is None):
+        import implementation
+        implementation.commandMain(os.path.basename(sys.argv[0]))
+    else:
+        sys.exit(status)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3.9
-import functools, os, sys, re
+import argparse, bisect, fnmatch, functools, hashlib, json, mmap, multiprocessing, multiprocessing.pool, os, socket, socketserver, stat, struct, sys, re, tempfile, threading, time, traceback
+from collections import namedtuple
 from operator import xor
 
 def m(pattern, string):
@@ -13,26 +14,95 @@ def m(pattern, string):
         ret.append(match.group(index))
     return ret
 
+class DiffFormatError(Exception):
+    # Raised when the input is not a valid diff. `code` is the error code from
+    # ERROR-CODES.md, e.g. 'HDF12', if the reason has one, and `lineNrs` lists
+    # the input lines the error is about.
+    def __init__(self, reason, lineNrs):
+        super().__init__(reason, lineNrs)
+        self.reason = reason
+        self.lineNrs = lineNrs
+        codem = re.match(r'\[(HDF[0-9]+)\]', reason)
+        self.code = codem[1] if codem else None
+    def __str__(self):
+        if(len(self.lineNrs)==1):
+            return f"On input line {self.lineNrs[0]}: {self.reason}"
+        return f"On input lines {', '.join([str(x) for x in self.lineNrs])}: {self.reason}"
+
+class ImplementationError(Exception):
+    pass
+
 def die(reason, lineNr):
     if(type(lineNr)==int):
-        sys.stderr.write(f"On input line {lineNr}: {reason}\n")
-        sys.exit(1)
+        raise DiffFormatError(reason, [lineNr])
     elif(type(lineNr)==list):
-        sys.stderr.write(f"On input lines {', '.join([str(x) for x in lineNr])}: {reason}\n")
-        sys.exit(1)
+        raise DiffFormatError(reason, lineNr)
     elif(lineNr==None):
-        sys.stderr.write(f"Possible implementatation bug.\n{reason}\n")
-        sys.exit(2)
+        raise ImplementationError(f"Possible implementatation bug.\n{reason}")
     else:
-        sys.stderr.write(f"Weird lineNr {repr(lineNr)}\n{reason}\n")
-        sys.exit(2)
+        raise ImplementationError(f"Weird lineNr {repr(lineNr)}\n{reason}")
 
-def getInputLines():
+# Input is read and decoded in blocks of this many bytes, and then split into
+# lines. Abusing latin1 encoding lets us handle several encodings and also
+# binary the same way. Buffered binary streams are read with read1(), so that
+# a block is handed on as soon as some input is available on a pipe or socket.
+inputBlockSize = 1<<20
+def readBlocks(f):
+    read = getattr(f, 'read1', f.read)
     while True:
-        line = sys.stdin.readline()
-        if not line:
+        block = read(inputBlockSize)
+        if not block:
             break
-        yield line
+        yield block if type(block)==str else block.decode('latin1')
+
+def decodeBlocks(view):
+    for start in range(0, len(view), inputBlockSize):
+        yield str(view[start:start+inputBlockSize], 'latin1')
+
+def mapBlocks(f):
+    if not os.fstat(f.fileno()).st_size:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        yield from decodeBlocks(view)
+
+def splitLines(blocks, pieces=False):
+    # A line can span any number of blocks, so its pieces are collected and
+    # only joined once its end is found. With pieces, a line is instead handed
+    # on in pieces of one or two blocks once it spans more than two, so that
+    # huge lines are neither held nor copied as a whole. All but the last piece
+    # of a line have no newline, see glueNonewline.
+    pending = []
+    for block in blocks:
+        if '\n' not in block:
+            if(pieces and len(pending)>1):
+                yield ''.join(pending)
+                pending = []
+            pending.append(block)
+            continue
+        lines = block.split('\n')
+        if pending:
+            pending.append(lines[0])
+            lines[0] = ''.join(pending)
+            pending = []
+        last = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if last:
+            pending.append(last)
+    if pending:
+        yield ''.join(pending)
+
+def getInputLines(path=None, pieces=False):
+    if path is None:
+        yield from splitLines(readBlocks(sys.stdin.buffer), pieces)
+        return
+    try:
+        f = open(path, 'rb')
+    except OSError as e:
+        sys.stderr.write(f"Cannot read {path}: {e.strerror}\n")
+        sys.exit(2)
+    with f:
+        yield from splitLines(mapBlocks(f), pieces)
 
 def nextOrDie(inputGenerator, message, lineNr):
     try:
@@ -40,167 +110,295 @@ def nextOrDie(inputGenerator, message, lineNr):
     except StopIteration:
         die(message, lineNr)
 
-def parseDiff(inputLines):
+def joinPieces(lineNr, line, inputLines):
+    # Returns the whole line that line is the first piece of, for lines that
+    # are not taken in pieces, or line itself if it is whole. A line without
+    # newline at the end of the input has no more pieces.
+    if line.endswith('\n'):
+        return [lineNr, line]
+    pieces = [line]
+    for [__ignored, line] in inputLines:
+        pieces.append(line)
+        if line.endswith('\n'):
+            break
+    return [lineNr, ''.join(pieces)]
+
+# Events passed between the processing stages. Every event has an `op` field
+# telling what it represents. Ops that carry the same information share an
+# event type, e.g. all five content ops are `Content` events. Events are
+# immutable, so stages that need to change a field yield a copy made with
+# `_replace`, while events that are passed on unchanged are shared.
+# Events inside a hunk refer to the `BeginHunk` event of that hunk rather than
+# carrying copies of its file and hunk context.
+BeginFile = namedtuple('BeginFile', 'op prefix filekey fileformat leftfile rightfile lineNr crlf')
+EndFile = namedtuple('EndFile', 'op prefix filekey lineNr')
+Labels = namedtuple('Labels', 'op prefix filekey left right lineNr leftcrlf rightcrlf')
+SimilarityIndex = namedtuple('SimilarityIndex', 'op prefix filekey similarityindex lineNr crlf')
+Rename = namedtuple('Rename', 'op prefix filekey left right lineNr leftcrlf rightcrlf')
+Index = namedtuple('Index', 'op prefix filekey left right mode lineNr crlf')
+FileMode = namedtuple('FileMode', 'op prefix filekey mode lineNr crlf')
+BeginHunk = namedtuple('BeginHunk', 'op prefix fileformat filekey hunkkey '
+                       'leftstartlineraw leftlinecountraw hunklinecountraw rightstartlineraw rightlinecountraw comment '
+                       'leftstartline rightstartline leftlinecount rightlinecount hunklinecount hunktype lineNr')
+# A `Content` event keeps the input line it was parsed from in `line` if
+# formatting the event gives that line again. Copies made with `_replace` drop
+# it, so that formatDiffRaw can write the line as it is for content events that
+# reach it unchanged and in their original hunk.
+# A content line taken in pieces, see splitLines, gives a `Content` event for
+# each piece, all but the last of which are `partial`.
+class Content(namedtuple('Content', 'op prefix content leftsnippetname rightsnippetname lineNr crlf hunk line partial', defaults=(None, False))):
+    __slots__ = ()
+    def _replace(self, **changes):
+        return super()._replace(line=None, **changes)
+Snippet = namedtuple('Snippet', 'op prefix name lineNr crlf hunk')
+EndSnippet = namedtuple('EndSnippet', 'op prefix name digest lineNr hunk')
+class EndHunk(namedtuple('EndHunk', 'op prefix leftchunks rightchunks lineNr hunk')):
+    __slots__ = ()
+    @property
+    def hunkkey(self):
+        return self.hunk.hunkkey
+    # The effective content of each side is collected as a list of chunks and
+    # only joined if some stage reads it.
+    @property
+    def leftcontent(self):
+        return joinChunks(self.leftchunks)
+    @property
+    def rightcontent(self):
+        return joinChunks(self.rightchunks)
+    # The validation looks at the content of a side only through these, see
+    # also CachedEndHunk
+    def sideDigest(self, side):
+        return contentDigest(getattr(self, f'{side}content'))
+    def sideLineCount(self, side):
+        # Returns the number of lines and whether the last one has no newline
+        content=getattr(self, f'{side}content')
+        nonl=bool(content) and not content.endswith('\n')
+        return content.count('\n') + (1 if nonl else 0), nonl
+# Counted hunk content, see countUnifiedHunk and countHintfulHunk
+HunkCount = namedtuple('HunkCount', 'op prefix added removed snippetnames lineNr hunk')
+# Grouped events, see groupHunks and groupFiles
+Hunk = namedtuple('Hunk', BeginHunk._fields + ('contents', 'endhunk'))
+File = namedtuple('File', BeginFile._fields + ('contents',))
+
+def joinChunks(chunks):
+    # Replace the chunks with the joined string, so that reading it again is cheap
+    if(len(chunks)!=1):
+        chunks[:]=[''.join(chunks)]
+    return chunks[0]
+
+# Line patterns are compiled once and matched against the whole line. Each line
+# kind is recognized by its first character after the optional `|` prefix, so
+# the tokenizer only needs to try the one pattern that can possibly match.
+hunkHeaderPattern = re.compile(r'(\|?)@@ +-([0-9]+)(,[0-9]+)? +(\(([0-9]+)\) +)?\+([0-9]+)(,[0-9]+)? +@@(.*)\n')
+leftLabelPattern = re.compile(r'(\|?)--- ([^\r]*)(\r*\n)')
+rightLabelPattern = re.compile(r'(\|?)\+\+\+ ([^\r]*)(\r*\n)')
+similarityIndexPattern = re.compile(r'(\|?)similarity index ([0-9]+%)(\r*\n)')
+renameFromPattern = re.compile(r'(\|?)rename from ([^\r]*)(\r*\n)')
+renameToPattern = re.compile(r'(\|?)rename to ([^\r]*)(\r*\n)')
+contentWithoutHeaderPattern = re.compile(r'\|?[-+ _#<>].*\n')
+indexPattern = re.compile(r'(\|?)index ([0-9a-f]{7,})\.\.([0-9a-f]{7,})( +[0-7]{6})?(\r*\n)')
+fileModePattern = re.compile(r'(\|?)(new|deleted) file mode ([^\r]*)(\r*\n)')
+fileHeaderPattern = re.compile(r'(\|?)diff --(git|hintful) ([^ ]+) +([^ \r]+)(\r*\n)')
+nonewlinePattern = re.compile(r'(\|?)\\.*\n')
+linePrefixPattern = re.compile(r'(\|?).*\n')
+unifiedContentPattern = re.compile(r'(\|?)([-+ ])(.*\n)')
+unifiedContentNonewlinePattern = re.compile(r'(\|?)([-+ ])(.*)\n\|?\\ .*\n')
+unifiedContentStartPattern = re.compile(r'(\|?)([-+ ])(.*)')
+unifiedContentNonewlineEndPattern = re.compile(r'(.*)\n\|?\\ .*\n')
+hintfulContentPattern = re.compile(r'(\|?)([-+ _#])(.*)([$\\])(\r*\n)')
+hintfulContentNonewlinePattern = re.compile(r'(\|?)([-+ _#])(.*)\n\|?\\ .*\n')
+hintfulContentStartPattern = re.compile(r'(\|?)([-+ _#])(.*)')
+hintfulContentEndPattern = re.compile(r'(.*)([$\\])(\r*\n)')
+hintfulContentNonewlineEndPattern = re.compile(r'.*\n\|?\\ .*\n')
+hintfulSnippetPattern = re.compile(r'(\|?)([<>])([^\r]*)(\r*\n)')
+crlfPattern = re.compile(r'\r*\n')
+fileHeaderStarts = ('diff --', '|diff --')
+# Patterns used when formatting output
+newlineSplitPattern = re.compile(r'(\n)')
+nonemptyLineStartPattern = re.compile(r'^(?=.)', re.M)
+
+def parseDiff(inputLines, selectFile=None, countOnly=False, keepLines=True):
+    # If selectFile is given, it is called with the key of each file comparison
+    # and nothing is yielded for those it returns False for. Content lines never
+    # begin like a file comparison header, so the lines of such file comparisons
+    # are skipped by looking only at how they begin, without being tokenized.
+    # With countOnly, the content of each hunk is not parsed but only counted,
+    # and yielded as a single HunkCount event following the `beginhunk` event.
+    # Without keepLines, `Content` events do not keep their input line, see
+    # keepsLines.
     filePrefix=None
     fileFormat=None
     fileKey=None
     betweenHeaderAndFirstHunk=False
+    skipping=False
     maxLineNr=0
     for [lineNr, line] in inputLines:
         maxLineNr=lineNr
-        linem = m(r'^(\|?)@@ +-([0-9]+)(,[0-9]+)? +(\([0-9]+\) +)?\+([0-9]+)(,[0-9]+)? +@@(.*)\n$', line)
+        if not line.endswith('\n'):
+            # Only hunk content is parsed in pieces
+            [lineNr, line] = joinPieces(lineNr, line, inputLines)
+        if(skipping and not line.startswith(fileHeaderStarts)):
+            continue
+        opchar = line[1:2] if line.startswith('|') else line[:1]
+        linem = hunkHeaderPattern.fullmatch(line) if opchar=='@' else None
         if(linem):
             prefix = linem[1]
             if prefix!=filePrefix: die('[HDF31] Hunk header prefix did not match previous line', lineNr)
             leftstartlineraw = linem[2]
             leftlinecountraw = linem[3]
             hunklinecountraw = linem[4]
-            rightstartlineraw = linem[5]
-            rightlinecountraw = linem[6]
-            comment = linem[7]
+            rightstartlineraw = linem[6]
+            rightlinecountraw = linem[7]
+            comment = linem[8]
             leftstartline = int(leftstartlineraw)
             rightstartline = int(rightstartlineraw)
             leftlinecount = int(leftlinecountraw[1:] if leftlinecountraw else '1')
             rightlinecount = int(rightlinecountraw[1:] if rightlinecountraw else '1')
-            hunklinecount = int(m(r'^\(([0-9]+)\) +$', hunklinecountraw)[1]) if hunklinecountraw else None
+            hunklinecount = int(linem[5]) if hunklinecountraw else None
             hunktype = 'hintful' if hunklinecountraw else 'unified'
             hunkKey = (fileKey, leftstartline, leftlinecount, rightstartline, rightlinecount)
-            extraFields = {'fileformat': fileFormat, 'filekey': fileKey, 'hunkkey': hunkKey}
-            hunkheader = {
-                'op': 'beginhunk',
-                'prefix': prefix,
-                **extraFields,
-                'leftstartlineraw': leftstartlineraw,
-                'leftlinecountraw': leftlinecountraw,
-                'hunklinecountraw': hunklinecountraw,
-                'rightstartlineraw': rightstartlineraw,
-                'rightlinecountraw': rightlinecountraw,
-                'comment': comment,
-                'leftstartline': leftstartline,
-                'rightstartline': rightstartline,
-                'leftlinecount': leftlinecount,
-                'rightlinecount': rightlinecount,
-                'hunklinecount': hunklinecount,
-                'hunktype': hunktype,
-                'lineNr': lineNr,
-            }
+            hunkheader = BeginHunk(
+                op='beginhunk',
+                prefix=prefix,
+                fileformat=fileFormat,
+                filekey=fileKey,
+                hunkkey=hunkKey,
+                leftstartlineraw=leftstartlineraw,
+                leftlinecountraw=leftlinecountraw,
+                hunklinecountraw=hunklinecountraw,
+                rightstartlineraw=rightstartlineraw,
+                rightlinecountraw=rightlinecountraw,
+                comment=comment,
+                leftstartline=leftstartline,
+                rightstartline=rightstartline,
+                leftlinecount=leftlinecount,
+                rightlinecount=rightlinecount,
+                hunklinecount=hunklinecount,
+                hunktype=hunktype,
+                lineNr=lineNr,
+            )
             yield hunkheader
             if(hunktype=='hintful'):
-                yield from parseHintfulHunk(hunkheader, inputLines, extraFields)
+                yield from countHintfulHunk(hunkheader, inputLines) if countOnly else parseHintfulHunk(hunkheader, inputLines, keepLines)
             else:
-                yield from parseUnifiedHunk(hunkheader, inputLines, extraFields)
+                yield from countUnifiedHunk(hunkheader, inputLines) if countOnly else parseUnifiedHunk(hunkheader, inputLines, keepLines)
             betweenHeaderAndFirstHunk=False
             continue
-        linem = m(r'^(\|?)--- ([^\r]*)(\r*\n)$', line)
+        linem = leftLabelPattern.fullmatch(line) if opchar=='-' else None
         if(linem):
             if not betweenHeaderAndFirstHunk: die('[HDF21] `---` line can only appear between file comparison header and first hunk', lineNr)
             if linem[1]!=filePrefix: die('[HDF31] Prefix for `---` line did not match previous line', lineNr)
-            [lineNr2, line2] = nextOrDie(inputLines, '[HDF22] Expected a `+++` line but got end of file', lineNr+1)
+            [lineNr2, line2] = joinPieces(*nextOrDie(inputLines, '[HDF22] Expected a `+++` line but got end of file', lineNr+1), inputLines)
             maxLineNr=lineNr2
-            line2m = m(r'^(\|?)\+\+\+ ([^\r]*)(\r*\n)$', line2)
+            line2m = rightLabelPattern.fullmatch(line2)
             if not line2 or not line2m:
                 die('[HDF22] Expected a `+++` line', lineNr2)
             if not (linem[1]==line2m[1]):
                 die('[HDF31] Prefix for `+++` line did not match previous line', lineNr2)
-            yield {
-                'op': 'labels',
-                'prefix': linem[1],
-                'filekey': fileKey,
-                'left': linem[2],
-                'right': line2m[2],
-                'lineNr': lineNr,
-                'leftcrlf': linem[3],
-                'rightcrlf': line2m[3],
-                }
+            yield Labels(
+                op='labels',
+                prefix=linem[1],
+                filekey=fileKey,
+                left=linem[2],
+                right=line2m[2],
+                lineNr=lineNr,
+                leftcrlf=linem[3],
+                rightcrlf=line2m[3],
+                )
             continue
-        linem = m(r'^(\|?)similarity index ([0-9]+%)(\r*\n)$', line)
+        linem = similarityIndexPattern.fullmatch(line) if opchar=='s' else None
         if(linem):
             if not betweenHeaderAndFirstHunk: die('[HDF21] `similarity index` line can only appear between file comparison header and first hunk', lineNr)
             if linem[1]!=filePrefix: die('[HDF31] Prefix for `similarity` line did not match previous line', lineNr)
-            yield {
-                'op': 'similarity-index',
-                'prefix': linem[1],
-                'filekey': fileKey,
-                'similarity-index': linem[2],
-                'lineNr': lineNr,
-                'crlf': linem[3],
-                }
+            yield SimilarityIndex(
+                op='similarity-index',
+                prefix=linem[1],
+                filekey=fileKey,
+                similarityindex=linem[2],
+                lineNr=lineNr,
+                crlf=linem[3],
+                )
             continue
-        linem = m(r'^(\|?)rename from ([^\r]*)(\r*\n)$', line)
+        linem = renameFromPattern.fullmatch(line) if opchar=='r' else None
         if(linem):
             if not betweenHeaderAndFirstHunk: die('[HDF21] `rename from` line can only appear between file comparison header and first hunk', lineNr)
             if linem[1]!=filePrefix: die('[HDF31] Prefix for `rename from` line did not match previous line', lineNr)
-            [lineNr2, line2] = nextOrDie(inputLines, '[HDF22] Expected `rename to` line but got end of file', lineNr+1)
+            [lineNr2, line2] = joinPieces(*nextOrDie(inputLines, '[HDF22] Expected `rename to` line but got end of file', lineNr+1), inputLines)
             maxLineNr=lineNr2
-            line2m = m(r'^(\|?)rename to ([^\r]*)(\r*\n)$', line2)
+            line2m = renameToPattern.fullmatch(line2)
             if not line2 or not line2m:
                 die('[HDF22] Expected `rename to` line', lineNr2)
             if not (linem[1]==line2m[1]):
                 die('[HDF31] Prefix for `rename to` line must match that of `rename from` line', lineNr2)
-            yield {
-                'op': 'rename',
-                'prefix': linem[1],
-                'filekey': fileKey,
-                'left': linem[2],
-                'right': line2m[2],
-                'lineNr': lineNr,
-                'leftcrlf': linem[3],
-                'rightcrlf': line2m[3],
-                }
+            yield Rename(
+                op='rename',
+                prefix=linem[1],
+                filekey=fileKey,
+                left=linem[2],
+                right=line2m[2],
+                lineNr=lineNr,
+                leftcrlf=linem[3],
+                rightcrlf=line2m[3],
+                )
             continue
-        if(m(r'^\|?[-+ _#<>].*\n$', line)):
+        if(opchar and opchar in '-+ _#<>' and contentWithoutHeaderPattern.fullmatch(line)):
             die(f'[HDF21] Hunk content without header: {line}', lineNr)
-        linem = m(r'^(\|?)index ([0-9a-f]{7,})\.\.([0-9a-f]{7,})( +[0-7]{6})?(\r*\n)$', line)
+        linem = indexPattern.fullmatch(line) if opchar=='i' else None
         if(linem):
             if not betweenHeaderAndFirstHunk: die('[HDF21] `index` line can only appear between file comparison header and first hunk', lineNr)
             if linem[1]!=filePrefix: die('[HDF31] Prefix for `index` line did not match previous line', lineNr)
-            yield {
-                'op': 'index',
-                'prefix': linem[1],
-                'filekey': fileKey,
-                'left': linem[2],
-                'right': linem[3],
-                'mode': linem[4],
-                'lineNr': lineNr,
-                'crlf': linem[5],
-                }
+            yield Index(
+                op='index',
+                prefix=linem[1],
+                filekey=fileKey,
+                left=linem[2],
+                right=linem[3],
+                mode=linem[4],
+                lineNr=lineNr,
+                crlf=linem[5],
+                )
             continue
-        linem = m(r'^(\|?)(new|deleted) file mode ([^\r]*)(\r*\n)$', line)
+        linem = fileModePattern.fullmatch(line) if opchar in ['n', 'd'] else None
         if(linem):
             if not betweenHeaderAndFirstHunk: die(f'[HDF21] `{linem[2]} file mode` line can only appear between file comparison header and first hunk', lineNr)
             if linem[1]!=filePrefix: die(f'[HDF31] Prefix for `{linem[2]} file mode` line did not match previous line', lineNr)
             side={'deleted': 'left', 'new': 'right'}[linem[2]]
-            yield {
-                'op': f'{side}filemode',
-                'prefix': linem[1],
-                'filekey': fileKey,
-                'mode': linem[3],
-                'lineNr': lineNr,
-                'crlf': linem[4],
-            }
+            yield FileMode(
+                op=f'{side}filemode',
+                prefix=linem[1],
+                filekey=fileKey,
+                mode=linem[3],
+                lineNr=lineNr,
+                crlf=linem[4],
+            )
             continue
-        linem = m(r'^(\|?)diff --(git|hintful) ([^ ]+) +([^ \r]+)(\r*\n)$', line)
+        linem = fileHeaderPattern.fullmatch(line) if opchar=='d' else None
         if(linem):
             if(filePrefix!=None):
-                yield {
-                    'op': 'endfile',
-                    'prefix': filePrefix,
-                    'filekey': fileKey,
-                    'lineNr': lineNr-1,
-                }
+                yield EndFile(
+                    op='endfile',
+                    prefix=filePrefix,
+                    filekey=fileKey,
+                    lineNr=lineNr-1,
+                )
             filePrefix=linem[1]
             fileFormat=linem[2]
             fileKey=(linem[3], linem[4])
-            yield {
-                'op': 'beginfile',
-                'prefix': filePrefix,
-                'filekey': fileKey,
-                'fileformat': fileFormat,
-                'leftfile': linem[3],
-                'rightfile': linem[4],
-                'lineNr': lineNr,
-                'crlf': linem[5],
-            }
+            skipping=selectFile is not None and not selectFile(fileKey)
+            if skipping:
+                filePrefix=None
+                betweenHeaderAndFirstHunk=False
+                continue
+            yield BeginFile(
+                op='beginfile',
+                prefix=filePrefix,
+                filekey=fileKey,
+                fileformat=fileFormat,
+                leftfile=linem[3],
+                rightfile=linem[4],
+                lineNr=lineNr,
+                crlf=linem[5],
+            )
             betweenHeaderAndFirstHunk=True
             continue
         if(betweenHeaderAndFirstHunk):
@@ -208,22 +406,43 @@ def parseDiff(inputLines):
         else:
             die(f"[HDF21] Cannot parse line '{line}'", lineNr)
     if(filePrefix!=None):
-        yield {
-            'op': 'endfile',
-            'prefix': filePrefix,
-            'filekey': fileKey,
-            'lineNr': maxLineNr,
-        }
-
-def glueNonewline(inputLines):
+        yield EndFile(
+            op='endfile',
+            prefix=filePrefix,
+            filekey=fileKey,
+            lineNr=maxLineNr,
+        )
+
+def glueNonewline(inputLines, lineNr=0):
+    # lineNr is the number of lines before inputLines in the input. The pieces
+    # of a line taken in pieces, see splitLines, are passed on with the number
+    # of that line, and a following `\ No newline at end of file` line is glued
+    # to its last piece.
     prevLine = ''
-    lineNr = 0
+    firstPiece = None
+    inputLines = iter(inputLines)
     for line in inputLines:
+        if(prevLine and not prevLine.endswith('\n')):
+            if firstPiece is None:
+                firstPiece = prevLine
+            yield [lineNr, prevLine]
+            prevLine = line
+            continue
         lineNr += 1
-        linem = m(r'^(\|?)\\.*\n$', line)
+        if(line.startswith(('\\', '|\\')) and not line.endswith('\n')):
+            pieces = [line]
+            for line in inputLines:
+                pieces.append(line)
+                if line.endswith('\n'):
+                    break
+            line = ''.join(pieces)
+        linem = nonewlinePattern.fullmatch(line) if line.startswith(('\\', '|\\')) else None
         if(linem):
-            prevLinem = m(r'^(\|?).*\n$', prevLine)
-            if(prevLinem[1]!=linem[1]):
+            if firstPiece is None:
+                prevPrefix = linePrefixPattern.fullmatch(prevLine)[1]
+            else:
+                prevPrefix = '|' if firstPiece.startswith('|') else ''
+            if(prevPrefix!=linem[1]):
                 die(r'[HDF31] Prefix before `\ No newline at end of file` must match the previous line', lineNr)
             yield [lineNr-1, prevLine + line]
             prevLine = ''
@@ -231,71 +450,125 @@ def glueNonewline(inputLines):
             if prevLine:
                 yield [lineNr-1, prevLine]
             prevLine = line
+        firstPiece = None
     if prevLine:
         yield [lineNr, prevLine]
 
-def parseUnifiedHunk(header, inputLines, extraFields):
-    leftlinecount = header['leftlinecount']
-    rightlinecount = header['rightlinecount']
-    leftcontent = ''
-    rightcontent = ''
-    lineNr=header['lineNr']
+unifiedContentOps = {'-': 'leftcontent', '+': 'rightcontent', ' ': 'bothcontent'}
+def parseUnifiedHunk(header, inputLines, keepLines=True):
+    leftlinecount = header.leftlinecount
+    rightlinecount = header.rightlinecount
+    leftchunks = []
+    rightchunks = []
+    lineNr=header.lineNr
     while(0 < leftlinecount or 0 < rightlinecount):
         if(leftlinecount < 0 or rightlinecount < 0):
-            die('[HDF11] Corrupt hunk line count', [header['lineNr'], lineNr])
+            die('[HDF11] Corrupt hunk line count', [header.lineNr, lineNr])
         [lineNr, line] = nextOrDie(inputLines, '[HDF11] End of file inside unified hunk', lineNr+1)
-        linem = m(r'^(\|?)([-+ ])(.*)\n\|?\\ .*\n$', line) or m(r'^(\|?)([-+ ])(.*\n)$', line)
+        if(line.find('\n')==len(line)-1):
+            linem = unifiedContentPattern.fullmatch(line)
+        else:
+            linem = unifiedContentNonewlinePattern.fullmatch(line)
         if linem:
             prefix = linem[1]
-            if prefix!=header['prefix']:
+            if prefix!=header.prefix:
                 die(f'[HDF31] Expected prefix for unified content line to match previous line', lineNr)
             opchar = linem[2]
             content = linem[3]
-            yield {
-                'op': {'-': 'leftcontent', '+': 'rightcontent', ' ': 'bothcontent'}[opchar],
-                'prefix': prefix,
-                'content': content,
-                'leftsnippetname': '',
-                'rightsnippetname': '',
-                'lineNr': lineNr,
-                **extraFields,
-                'crlf': '\n',
-            }
+            yield Content(unifiedContentOps[opchar], prefix, content, '', '', lineNr, '\n', header, line if keepLines and content.endswith('\n') else None)
             if(opchar in '- '):
                 leftlinecount-=1
-                leftcontent+=content
+                leftchunks.append(content)
             if(opchar in '+ '):
                 rightlinecount-=1
-                rightcontent+=content
+                rightchunks.append(content)
             continue
+        linem = unifiedContentStartPattern.fullmatch(line) if not line.endswith('\n') else None
+        if linem:
+            # The first piece of a line taken in pieces. Each piece is passed on
+            # once the next one has been read, so that a line cut off by the end
+            # of the input is reported before any of it is passed on, and
+            # without trailing CRs, which are left to the next one so that no
+            # `\r*\n` sequence is split.
+            prefix = linem[1]
+            if prefix!=header.prefix:
+                die(f'[HDF31] Expected prefix for unified content line to match previous line', lineNr)
+            opchar = linem[2]
+            op = unifiedContentOps[opchar]
+            content = linem[3]
+            while True:
+                nextLine = next(inputLines, None)
+                if nextLine is None:
+                    die(f"[HDF12] Corrupt hunk, contained line: '{line}'", lineNr)
+                piece = content.rstrip('\r')
+                if piece:
+                    yield Content(op, prefix, piece, '', '', lineNr, '\n', header, None, True)
+                    if(opchar in '- '):
+                        leftchunks.append(piece)
+                    if(opchar in '+ '):
+                        rightchunks.append(piece)
+                line = content[len(piece):] + nextLine[1]
+                if line.endswith('\n'):
+                    break
+                content = line
+            if(line.find('\n')==len(line)-1):
+                content = line
+            else:
+                linem = unifiedContentNonewlineEndPattern.fullmatch(line)
+                if not linem:
+                    die(f"[HDF12] Corrupt hunk, contained line: '{line}'", lineNr)
+                content = linem[1]
+            yield Content(op, prefix, content, '', '', lineNr, '\n', header)
+            if(opchar in '- '):
+                leftlinecount-=1
+                leftchunks.append(content)
+            if(opchar in '+ '):
+                rightlinecount-=1
+                rightchunks.append(content)
+            continue
+        [lineNr, line] = joinPieces(lineNr, line, inputLines)
         die(f"[HDF12] Corrupt hunk, contained line: '{line}'", lineNr)
-    yield {
-        'op': 'endhunk',
-        'prefix': header['prefix'],
-        'leftcontent': leftcontent,
-        'rightcontent': rightcontent,
-        'lineNr': lineNr,
-        **extraFields,
-    }
+    yield EndHunk('endhunk', header.prefix, leftchunks, rightchunks, lineNr, header)
 
-def parseHintfulHunk(header, inputLines, extraFields):
+hintfulContentOps = {'-': 'leftcontent', '+': 'rightcontent', ' ': 'bothcontent', '_': 'bothlowprioritycontent', '#': 'ignorecontent'}
+def parseHintfulHunk(header, inputLines, keepLines=True):
     state={
-        'leftcontent': '',
-        'rightcontent': '',
+        'leftcontent': [],
+        'rightcontent': [],
         'leftsnippetname': '',
         'rightsnippetname': '',
-        'leftsnippetcontent': '',
-        'rightsnippetcontent': '',
+        # Snippet content is only ever compared, so it is hashed as it comes
+        # rather than kept
+        'leftsnippetcontent': None,
+        'rightsnippetcontent': None,
+    }
+    # Whether the last nonempty chunk appended to each target ended with `\r`
+    endsWithCR={
+        'leftcontent': False,
+        'rightcontent': False,
+        'leftsnippetcontent': False,
+        'rightsnippetcontent': False,
     }
-    lineNr=header['lineNr']
-    for _ in range(header['hunklinecount']):
+    def addContent(op, content, lineNr):
+        for side in ['left', 'right']:
+            if(op in [f'{side}content', 'bothcontent', 'bothlowprioritycontent']):
+                target = f'{side}snippetcontent' if state[f'{side}snippetname'] else f'{side}content'
+                if(endsWithCR[target] and crlfPattern.fullmatch(content)):
+                    die(r'[HDF16] `\r*\n` sequence must not be split.', lineNr)
+                if(content):
+                    if(state[f'{side}snippetname']):
+                        state[target].update(content.encode('latin1'))
+                    else:
+                        state[target].append(content)
+                    endsWithCR[target]=content.endswith('\r')
+    lineNr=header.lineNr
+    for _ in range(header.hunklinecount):
         [lineNr, line] = nextOrDie(inputLines, '[HDF11] End of file inside hintful hunk', lineNr+1)
-        if m(r'^(\|?)([-+ _#])(.*)\n\|?\\ .*\n$', line):
-            die('[HDF17] Encountered `\ No newline at end of file` syntax in hintful hunk', lineNr+1)
-        linem = m(r'^(\|?)([-+ _#])(.*)([$\\])(\r*\n)$', line)
+        opchar = line[1:2] if line.startswith('|') else line[:1]
+        linem = hintfulContentPattern.fullmatch(line) if opchar and opchar in '-+ _#' else None
         if(linem):
             prefix = linem[1]
-            if prefix!=header['prefix']:
+            if prefix!=header.prefix:
                 die(f'[HDF31] Expected prefix for hintful content line to match previous line', lineNr)
             opchar = linem[2]
             content = linem[3]
@@ -305,28 +578,52 @@ def parseHintfulHunk(header, inputLines, extraFields):
                 if(content.endswith('\r')):
                     die('[HDF16] CR character not allowed before $ newline marker', lineNr)
                 content += crlf
-            op = {'-': 'leftcontent', '+': 'rightcontent', ' ': 'bothcontent', '_': 'bothlowprioritycontent', '#': 'ignorecontent'}[opchar]
-            yield {
-                'op': op,
-                'prefix': prefix,
-                'content': content,
-                'leftsnippetname': state['leftsnippetname'],
-                'rightsnippetname': state['rightsnippetname'],
-                'lineNr': lineNr,
-                **extraFields,
-                'crlf': crlf,
-            }
-            for side in ['left', 'right']:
-                if(op in [f'{side}content', 'bothcontent', 'bothlowprioritycontent']):
-                    target = f'{side}snippetcontent' if state[f'{side}snippetname'] else f'{side}content'
-                    if(state[target].endswith('\r') and m(r'^\r*\n', content)):
-                        die(r'[HDF16] `\r*\n` sequence must not be split.', lineNr)
-                    state[target]+=content
+            op = hintfulContentOps[opchar]
+            yield Content(op, prefix, content, state['leftsnippetname'], state['rightsnippetname'], lineNr, crlf, header, line if keepLines else None)
+            addContent(op, content, lineNr)
             continue
-        linem = m(r'^(\|?)([<>])([^\r]*)(\r*\n)$', line)
+        linem = hintfulContentStartPattern.fullmatch(line) if not line.endswith('\n') else None
         if(linem):
+            # The first piece of a line taken in pieces, passed on like those of
+            # unified content lines, see parseUnifiedHunk, except that anything
+            # that could be the newline marker is also left to the next piece
             prefix = linem[1]
-            if prefix!=header['prefix']:
+            if prefix!=header.prefix:
+                die(f'[HDF31] Expected prefix for hintful content line to match previous line', lineNr)
+            op = hintfulContentOps[linem[2]]
+            content = linem[3]
+            while True:
+                nextLine = next(inputLines, None)
+                if nextLine is None:
+                    die(f"[HDF12] Corrupt hunk: Strange line: '{line}'", lineNr)
+                piece = content.rstrip('\r$\\')
+                if piece:
+                    yield Content(op, prefix, piece, state['leftsnippetname'], state['rightsnippetname'], lineNr, '', header, None, True)
+                    addContent(op, piece, lineNr)
+                line = content[len(piece):] + nextLine[1]
+                if line.endswith('\n'):
+                    break
+                content = line
+            linem = hintfulContentEndPattern.fullmatch(line)
+            if not linem:
+                if hintfulContentNonewlineEndPattern.fullmatch(line):
+                    die('[HDF17] Encountered `\ No newline at end of file` syntax in hintful hunk', lineNr+1)
+                die(f"[HDF12] Corrupt hunk: Strange line: '{line}'", lineNr)
+            content = linem[1]
+            crlf = linem[3]
+            if(linem[2]=='$'):
+                if(content.endswith('\r')):
+                    die('[HDF16] CR character not allowed before $ newline marker', lineNr)
+                content += crlf
+            yield Content(op, prefix, content, state['leftsnippetname'], state['rightsnippetname'], lineNr, crlf, header)
+            addContent(op, content, lineNr)
+            continue
+        # Other lines are never parsed in pieces
+        [lineNr, line] = joinPieces(lineNr, line, inputLines)
+        linem = hintfulSnippetPattern.fullmatch(line) if opchar and opchar in '<>' else None
+        if(linem):
+            prefix = linem[1]
+            if prefix!=header.prefix:
                 die(f'[HDF31] Expected prefix for hintful snippet line to match previous line', lineNr)
             opchar = linem[2]
             name = linem[3]
@@ -335,40 +632,200 @@ def parseHintfulHunk(header, inputLines, extraFields):
             for side in ['left', 'right']:
                 if(op==f'{side}snippet'):
                     if state[f'{side}snippetname']:
-                        yield {
-                            'op': f'end{side}snippet',
-                            'prefix': prefix,
-                            'name': state[f'{side}snippetname'],
-                            'content': state[f'{side}snippetcontent'],
-                            'lineNr': lineNr,
-                            **extraFields,
-                        }
+                        yield EndSnippet(f'end{side}snippet', prefix, state[f'{side}snippetname'], state[f'{side}snippetcontent'].digest(), lineNr, header)
                     state[f'{side}snippetname']=name
-                    state[f'{side}snippetcontent']=''
-            yield {
-                'op': op,
-                'prefix': prefix,
-                'name': name,
-                'lineNr': lineNr,
-                **extraFields,
-                'crlf': crlf,
-            }
+                    state[f'{side}snippetcontent']=hashlib.blake2b(digest_size=16) if name else None
+                    endsWithCR[f'{side}snippetcontent']=False
+            yield Snippet(op, prefix, name, lineNr, crlf, header)
             continue
+        if(opchar and opchar in '-+ _#' and hintfulContentNonewlinePattern.fullmatch(line)):
+            die('[HDF17] Encountered `\ No newline at end of file` syntax in hintful hunk', lineNr+1)
         die(f"[HDF12] Corrupt hunk: Strange line: '{line}'", lineNr)
     if(state['leftsnippetname'] or state['rightsnippetname']):
         die('[HDF13] Hunk ended inside named snippet', lineNr)
-    yield {
-        'op': 'endhunk',
-        'prefix': header['prefix'],
-        **extraFields,
-        'leftcontent': state['leftcontent'],
-        'rightcontent': state['rightcontent'],
-        'lineNr': lineNr,
+    yield EndHunk('endhunk', header.prefix, state['leftcontent'], state['rightcontent'], lineNr, header)
+
+# The count functions read the same lines as the parse functions, but look only
+# at the op character and the newline marker of each line, so that no content
+# is sliced out. Lines are counted like `git diff --numstat` counts them: a line
+# with any changed part counts as removed from the left side or added to the
+# right side.
+def countUnifiedHunk(header, inputLines):
+    leftlinecount = header.leftlinecount
+    rightlinecount = header.rightlinecount
+    added = 0
+    removed = 0
+    opIndex = len(header.prefix)
+    lineNr=header.lineNr
+    while(0 < leftlinecount or 0 < rightlinecount):
+        if(leftlinecount < 0 or rightlinecount < 0):
+            die('[HDF11] Corrupt hunk line count', [header.lineNr, lineNr])
+        [lineNr, line] = nextOrDie(inputLines, '[HDF11] End of file inside unified hunk', lineNr+1)
+        opchar = line[opIndex:opIndex+1]
+        if(opchar=='-'):
+            leftlinecount-=1
+            removed+=1
+        elif(opchar=='+'):
+            rightlinecount-=1
+            added+=1
+        elif(opchar==' '):
+            leftlinecount-=1
+            rightlinecount-=1
+        else:
+            die(f"[HDF12] Corrupt hunk, contained line: '{line}'", lineNr)
+    yield HunkCount('hunkcount', header.prefix, added, removed, frozenset(), lineNr, header)
+
+def countHintfulHunk(header, inputLines):
+    # A change on one side also changes the line being built on the other side,
+    # if that line has begun or continues with content of both sides.
+    added = 0
+    removed = 0
+    snippetnames = set()
+    leftsnippet = False
+    rightsnippet = False
+    leftbegun = rightbegun = False
+    leftchanged = rightchanged = False
+    opIndex = len(header.prefix)
+    lineNr=header.lineNr
+    for _ in range(header.hunklinecount):
+        [lineNr, line] = nextOrDie(inputLines, '[HDF11] End of file inside hintful hunk', lineNr+1)
+        opchar = line[opIndex:opIndex+1]
+        if(opchar and opchar in '<>'):
+            name = line[opIndex+1:].rstrip('\r\n')
+            if(opchar=='<'):
+                leftsnippet = bool(name)
+            else:
+                rightsnippet = bool(name)
+            if name:
+                snippetnames.add(name)
+            continue
+        markerIndex = len(line)-2
+        while(opIndex < markerIndex and line[markerIndex]=='\r'):
+            markerIndex -= 1
+        if not (opchar and opchar in '-+ _#' and line[markerIndex] in '$\\' and opIndex < markerIndex):
+            die(f"[HDF12] Corrupt hunk: Strange line: '{line}'", lineNr)
+        newline = line[markerIndex]=='$'
+        if not (newline or opIndex+1 < markerIndex):
+            continue
+        left = opchar in '- _' and not leftsnippet
+        right = opchar in '+ _' and not rightsnippet
+        if(left and right):
+            if(leftchanged or rightchanged):
+                leftchanged = rightchanged = True
+        elif left:
+            leftchanged = True
+            rightchanged = rightchanged or rightbegun
+        elif right:
+            rightchanged = True
+            leftchanged = leftchanged or leftbegun
+        if left:
+            leftbegun = not newline
+            if newline:
+                removed += leftchanged
+                leftchanged = False
+        if right:
+            rightbegun = not newline
+            if newline:
+                added += rightchanged
+                rightchanged = False
+    removed += leftbegun and leftchanged
+    added += rightbegun and rightchanged
+    yield HunkCount('hunkcount', header.prefix, added, removed, frozenset(snippetnames), lineNr, header)
+
+def formatDiffRaw(inputObjs):
+    # Produces the same output as the highlight task without any colorization,
+    # building one string per input object.
+    hunk=None
+    hunktype=None
+    prefix=''
+    atBeginningOfLine=True
+    # Whether the previous content event was a partial one, see Content
+    continuing=False
+    contentChars={
+        'leftcontent': '-',
+        'rightcontent': '+',
+        'bothcontent': ' ',
+        'bothlowprioritycontent': '_',
+        'ignorecontent': '#',
     }
+    for obj in inputObjs:
+        op=obj.op
+        if(op in contentChars):
+            # Content lines always begin a line, and a prefixed line already
+            # has the prefix of the file comparison if the prefixes match
+            if(obj.line and obj.hunk is hunk and obj.prefix==prefix):
+                yield obj.line
+                continue
+            content=obj.content
+            char='' if continuing else contentChars[op]
+            continuing=obj.partial
+            if(continuing):
+                text=char+content
+            elif(hunktype=='unified'):
+                if content.endswith('\n'):
+                    text=char+content
+                else:
+                    text=f'{char}{content}{obj.crlf}\\ No newline at end of file\n'
+            elif(hunktype=='hintful'):
+                if content.endswith('\n'):
+                    line=content.rstrip('\r\n')
+                    text=f'{char}{line}${content[len(line):]}'
+                else:
+                    text=f'{char}{content}\\{obj.crlf}'
+            else:
+                die('Unexpected hunk type', None)
+        elif(op=='beginhunk'):
+            hunk=obj
+            hunktype=obj.hunktype
+            hunklinecount=f' ({obj.hunklinecount})' if hunktype=='hintful' else ''
+            text=f'@@ -{obj.leftstartlineraw}{obj.leftlinecountraw or ""}{hunklinecount} +{obj.rightstartlineraw}{obj.rightlinecountraw or ""} @@{obj.comment}\n'
+        elif(op in ['leftsnippet', 'rightsnippet']):
+            text=f"{'<' if op=='leftsnippet' else '>'}{obj.name}{obj.crlf}"
+        elif(op in ['endleftsnippet', 'endrightsnippet', 'endfile']):
+            continue
+        elif(op=='endhunk'):
+            hunk=None
+            hunktype=None
+            continue
+        elif(op=='labels'):
+            text=f"--- {obj.left}{obj.leftcrlf}+++ {obj.right}{obj.rightcrlf}"
+        elif(op=='beginfile'):
+            prefix=obj.prefix
+            text=f"diff --{obj.fileformat} {obj.leftfile} {obj.rightfile}{obj.crlf}"
+        elif(op=='index'):
+            text=f"index {obj.left}..{obj.right}{obj.mode or ''}{obj.crlf}"
+        elif(op.endswith('filemode')):
+            text=f"{'deleted' if op=='leftfilemode' else 'new'} file mode {obj.mode}{obj.crlf}"
+        elif(op=='similarity-index'):
+            text=f"similarity index {obj.similarityindex}{obj.crlf}"
+        elif(op=='rename'):
+            text=f"rename from {obj.left}{obj.leftcrlf}rename to {obj.right}{obj.rightcrlf}"
+        else:
+            die(f'formatDiffHelper cannot process operation {op}', None)
+        if not text:
+            continue
+        if prefix:
+            if atBeginningOfLine:
+                text=nonemptyLineStartPattern.sub(lambda _: prefix, text)
+            else:
+                i=text.find('\n')+1
+                if i:
+                    text=text[:i]+nonemptyLineStartPattern.sub(lambda _: prefix, text[i:])
+        atBeginningOfLine=text.endswith('\n')
+        yield text
 
 def formatDiffHelper(inputObjs, task="raw"):
     if(task not in ["raw", "highlight", "visualize"]):
         die(f"Bad task {task} in formatDiffHelper", None)
+    if(task=="raw"):
+        yield from formatDiffRaw(inputObjs)
+        return
+    for chunk in formatDiffChunks(inputObjs, task):
+        yield from chunk
+
+def formatDiffChunks(inputObjs, task):
+    # Yields the output of formatDiffHelper as lists of strings and
+    # colorization objects.
     def interpretAndColorize(inputObjs):
         hunktype=None
         seenPrefixedHunks=set()
@@ -376,11 +833,11 @@ def formatDiffHelper(inputObjs, task="raw"):
         fileKey=None
         palette=["stdfg", "stdbg", "red", "green", "magenta", "grey"]
         snippetcolors={'leftsnippet': 'red', 'rightsnippet': 'green'}
-        bar='' if task=="raw" else {'op': 'bar'}
+        bar={'op': 'bar'}
         leftsnippetname=''
         rightsnippetname=''
+        continuing=False
         def colorize(fg="stdfg", bold=False, bg="stdbg"):
-            if(task=="raw"): return ''
             if(suppressed):
                 return {
                     'op': 'colorize',
@@ -401,16 +858,16 @@ def formatDiffHelper(inputObjs, task="raw"):
                 'bg': bg,
             }
         for obj in inputObjs:
-            op=obj['op']
+            op=obj.op
             if(op=='beginhunk'):
                 hunkKey=(*fileKey,
-                         obj['leftstartline'],
-                         obj['leftlinecount'],
-                         obj['rightstartline'],
-                         obj['rightlinecount'],
+                         obj.leftstartline,
+                         obj.leftlinecount,
+                         obj.rightstartline,
+                         obj.rightlinecount,
                          )
-                hunktype=obj['hunktype']
-                if(obj['prefix']):
+                hunktype=obj.hunktype
+                if(obj.prefix):
                     seenPrefixedHunks.add(hunkKey)
                     suppressed=False
                 elif(hunkKey in seenPrefixedHunks):
@@ -420,21 +877,21 @@ def formatDiffHelper(inputObjs, task="raw"):
                 yield from [
                     colorize(fg="magenta", bold=True),
                     '@@ -',
-                    obj['leftstartlineraw'],
-                    obj['leftlinecountraw'] or '',
+                    obj.leftstartlineraw,
+                    obj.leftlinecountraw or '',
                 ]
                 if(hunktype=='hintful'):
                     yield from [
                         ' (',
-                        str(obj['hunklinecount']),
+                        str(obj.hunklinecount),
                         ')',
                     ]
                 yield from [
                     ' +',
-                    obj['rightstartlineraw'],
-                    obj['rightlinecountraw'] or '',
+                    obj.rightstartlineraw,
+                    obj.rightlinecountraw or '',
                     ' @@',
-                    obj['comment'],
+                    obj.comment,
                     '\n',
                 ]
             elif(op.endswith('content')):
@@ -453,20 +910,26 @@ def formatDiffHelper(inputObjs, task="raw"):
                 }[op]
                 if charbgcolor=="stdfg" and charfgcolor=="stdfg":
                     charfgcolor="stdbg"
-                if not(task=="visualize" and hunktype=="hintful"):
+                if not(task=="visualize" and hunktype=="hintful" or continuing):
                     yield colorize(fg=charfgcolor, bg=charbgcolor)
                     yield char
                     if not suppressed:
                         yield colorize(fg="grey")
                         yield bar
-                content = obj['content']
-                yield colorize(fg=contentfgcolor, bg=contentbgcolor)
+                content = obj.content
+                if not continuing:
+                    yield colorize(fg=contentfgcolor, bg=contentbgcolor)
+                continuing = obj.partial
                 nlmColorize=colorize(fg=nlmfgcolor)
-                if(hunktype=='unified'):
-                    yield obj['content']
-                    if not obj['content'].endswith('\n'):
+                if(continuing):
+                    # A piece of a line, see Content, which is highlighted as
+                    # soon as it has been read
+                    yield content
+                elif(hunktype=='unified'):
+                    yield obj.content
+                    if not obj.content.endswith('\n'):
                         yield from [
-                            obj['crlf'],
+                            obj.crlf,
                             nlmColorize,
                             '\\',
                             colorize(fg="grey"),
@@ -489,24 +952,24 @@ def formatDiffHelper(inputObjs, task="raw"):
                             yield from [
                                 nlmColorize,
                                 '\\',
-                                obj['crlf'],
+                                obj.crlf,
                             ]
                 else:
                     die('Unexpected hunk type', None)
             elif(op in ['leftsnippet', 'rightsnippet']):
                 if(op=="leftsnippet"):
-                    leftsnippetname=obj['name']
+                    leftsnippetname=obj.name
                 else:
-                    rightsnippetname=obj['name']
+                    rightsnippetname=obj.name
                 char={'leftsnippet': '<', 'rightsnippet': '>'}[op]
                 if(task=="visualize" and hunktype=="hintful"):
-                    glue=(task=="visualize" and hunktype=="hintful" and not obj['name'])
+                    glue=(task=="visualize" and hunktype=="hintful" and not obj.name)
                     if glue:
                         yield { 'op': 'beginGlueContent' }
                     yield from [
                         colorize(fg=snippetcolors[op], bg="stdfg", bold=True),
                         char,
-                        obj['name'],
+                        obj.name,
                     ]
                     if glue:
                         yield { 'op': 'endGlueContent' }
@@ -517,8 +980,8 @@ def formatDiffHelper(inputObjs, task="raw"):
                         colorize(fg="grey"),
                         bar,
                         colorize(fg=snippetcolors[op], bg="stdfg", bold=True),
-                        obj['name'],
-                        obj['crlf'],
+                        obj.name,
+                        obj.crlf,
                     ]
             elif(op in ['endleftsnippet', 'endrightsnippet']):
                 pass
@@ -529,201 +992,193 @@ def formatDiffHelper(inputObjs, task="raw"):
             elif(op in ['labels']):
                 yield from [
                     colorize(fg="red", bold=True),
-                    f"--- {obj['left']}",
-                    obj['leftcrlf'],
+                    f"--- {obj.left}",
+                    obj.leftcrlf,
                     colorize(fg="green", bold=True),
-                    f"+++ {obj['right']}",
-                    obj['rightcrlf'],
+                    f"+++ {obj.right}",
+                    obj.rightcrlf,
                 ]
             elif(op=='beginfile'):
                 suppressed=False
                 yield {
                     'op': 'setprefix',
-                    'prefix': [colorize(fg="grey"), obj['prefix'], colorize()] if obj['prefix'] else []
+                    'prefix': [colorize(fg="grey"), obj.prefix, colorize()] if obj.prefix else []
                 }
-                fileKey=(obj['leftfile'], obj['rightfile'])
+                fileKey=(obj.leftfile, obj.rightfile)
                 yield from [
                     colorize(bold=True),
-                    f"diff --{obj['fileformat']} {obj['leftfile']} {obj['rightfile']}{obj['crlf']}",
+                    f"diff --{obj.fileformat} {obj.leftfile} {obj.rightfile}{obj.crlf}",
                 ]
             elif(op=='index'):
                 yield from [
                     colorize(bold=True),
-                    f"index {obj['left']}..{obj['right']}",
-                    obj['mode'] if obj['mode'] else '',
-                    obj['crlf'],
+                    f"index {obj.left}..{obj.right}",
+                    obj.mode if obj.mode else '',
+                    obj.crlf,
                 ]
             elif(op.endswith('filemode')):
                 yield from [
                     colorize(fg={'leftfilemode': 'red', 'rightfilemode': 'green'}[op], bold=True),
                     {'leftfilemode': 'deleted', 'rightfilemode': 'new'}[op],
                     ' file mode ',
-                    obj['mode'],
-                    obj['crlf'],
+                    obj.mode,
+                    obj.crlf,
                 ]
             elif(op=='similarity-index'):
-                yield f"similarity index {obj['similarity-index']}{obj['crlf']}"
+                yield f"similarity index {obj.similarityindex}{obj.crlf}"
             elif(op=='rename'):
                 yield from [
                     colorize(bold=True),
-                    f"rename from {obj['left']}{obj['leftcrlf']}",
+                    f"rename from {obj.left}{obj.leftcrlf}",
                     colorize(bold=True),
-                    f"rename to {obj['right']}{obj['rightcrlf']}",
+                    f"rename to {obj.right}{obj.rightcrlf}",
                 ]
             else:
                 die(f'formatDiffHelper cannot process operation {op}', None)
-    def separateNewlines(inputObjs):
-        for obj in inputObjs:
-            if(type(obj)==str and '\n' in obj):
-                while('\n' in obj):
-                    i=obj.index('\n')
-                    yield obj[:i]
-                    yield '\n'
-                    obj=obj[i+1:]
-            yield obj
-    def processNewlineDeferment(inputObjs):
-        gluecontent=False
-        deferred=""
-        prevObj=None
-        for obj in inputObjs:
-            if(obj==''):
-                continue
-            elif(type(obj)==dict and obj['op']=='beginGlueContent'):
-                if(type(prevObj)==dict and prevObj['op']=='endGlueContent'):
-                    prevObj=None
-                elif(prevObj=='\n'):
-                    deferred+=prevObj
-                    prevObj=None
-                    gluecontent=True
-                else:
-                    gluecontent=True
-            else:
-                if(type(prevObj)==dict and prevObj['op']=='endGlueContent'):
-                    yield deferred
-                    deferred=""
-                elif(prevObj):
-                    yield prevObj
-                prevObj=obj
+    # Separates newlines, defers newlines around glued content, ends
+    # colorization at newlines, removes empty strings, deduplicates
+    # colorization and inserts line prefixes, all in a single pass.
+    out=[]
+    prefix=[]
+    atBeginningOfLine=True
+    pendingColorization=None
+    deferred=""
+    prevObj=None
+    endColorization={
+        'op': 'colorize',
+        'fg': "stdfg",
+        'bold': False,
+        'bg': "stdbg",
+    }
+    def put(obj):
+        nonlocal prefix, atBeginningOfLine, pendingColorization
+        if(type(obj)==dict):
+            op=obj['op']
+            if(op=='colorize'):
+                pendingColorization=obj
+                return
+        elif(obj==''):
+            return
+        else:
+            op=None
+            if(obj=='\n'):
+                pendingColorization=endColorization
+        if(pendingColorization):
+            if atBeginningOfLine:
+                out.extend(prefix)
+                atBeginningOfLine=False
+            out.append(pendingColorization)
+            pendingColorization=None
+        if(op=="setprefix"):
+            prefix=obj['prefix']
+        elif(obj=='\n'):
+            out.append(obj)
+            atBeginningOfLine=True
+        elif(op==None):
+            if atBeginningOfLine:
+                out.extend(prefix)
+                atBeginningOfLine=False
+            out.append(obj)
+        elif(op=="bar"):
+            if atBeginningOfLine:
+                die(f'Bar at beginning of line', None)
+            out.append(obj)
+        else:
+            die(f'Strange object in formatDiffHelper: {repr(obj)}', None)
+    def finish():
+        nonlocal deferred
         if(type(prevObj)==dict and prevObj['op']=='endGlueContent'):
-            yield deferred
+            put(deferred)
             deferred=""
         elif(prevObj):
-            yield prevObj
-        if(deferred):
-            die('processNewlineDeferment ended before inserting deferred newlines', None)
-    def processColorizationEndAtNewline(inputObjs):
-        for obj in inputObjs:
-            if(obj=='\n' and task!="raw"):
-                yield {
-                    'op': 'colorize',
-                    'fg': "stdfg",
-                    'bold': False,
-                    'bg': "stdbg",
-                }
-            yield obj
-    def removeEmpty(inputObjs):
-        for obj in inputObjs:
-            if(obj==''):
-                pass
-            else:
-                yield obj
-    def deduplicateColorization(inputObjs):
-        prevObj=None
-        for obj in inputObjs:
-            if(not(type(prevObj)==dict and prevObj['op']=='colorize' and
-                   type(obj)==dict and obj['op']=='colorize') and
-               prevObj!=None):
-                yield prevObj
-            prevObj=obj
-        if not(prevObj==None):
-            yield prevObj
-    def processPrefix(inputObjs):
-        prefix=[]
-        atBeginningOfLine=True
-        for obj in inputObjs:
-            op=obj['op'] if type(obj)==dict else None
-            if(op=="setprefix"):
-                prefix=obj['prefix']
-            elif(obj=='\n'):
-                yield obj
-                atBeginningOfLine=True
-            elif(type(obj)==str or op=="colorize"):
-                if atBeginningOfLine:
-                    yield from prefix
-                yield obj
-                atBeginningOfLine=False
-            elif(op=="bar"):
-                if atBeginningOfLine:
-                    die(f'Bar at beginning of line', None)
+            put(prevObj)
+    try:
+        for token in interpretAndColorize(inputObjs):
+            for obj in (newlineSplitPattern.split(token) if type(token)==str and '\n' in token else (token,)):
+                if(obj==''):
+                    continue
+                elif(type(obj)==dict and obj['op']=='beginGlueContent'):
+                    if(type(prevObj)==dict and prevObj['op']=='endGlueContent'):
+                        prevObj=None
+                    elif(prevObj=='\n'):
+                        deferred+=prevObj
+                        prevObj=None
                 else:
-                    yield obj
-            else:
-                die(f'Strange object in processPrefix: {repr(obj)}', None)
-    def reducer(reduced, next_generator):
-        return next_generator(reduced)
-    procStack=[
-        interpretAndColorize,
-        separateNewlines,
-        processNewlineDeferment,
-        processColorizationEndAtNewline,
-        removeEmpty,
-        deduplicateColorization,
-        processPrefix,
-    ]
-    yield from functools.reduce(reducer, procStack, inputObjs)
+                    if(type(prevObj)==dict and prevObj['op']=='endGlueContent'):
+                        put(deferred)
+                        deferred=""
+                    elif(prevObj):
+                        put(prevObj)
+                    prevObj=obj
+            # Pieces of huge lines are handed on as they come
+            if(len(out)>=1024 or type(token)==str and len(token)>=inputBlockSize):
+                yield out
+                out=[]
+    except (DiffFormatError, ImplementationError):
+        # Hand on what was formatted before the error, so that it is written
+        # like the lines before an error in the other commands
+        finish()
+        yield out
+        raise
+    finish()
+    if(deferred):
+        die('formatDiffHelper ended before inserting deferred newlines', None)
+    if(pendingColorization):
+        if atBeginningOfLine:
+            out.extend(prefix)
+        out.append(pendingColorization)
+    yield out
 
-def formatTerminal(inputObjs):
-    currentColorization={
-        'fg': "stdfg",
-        'bold': False,
-        'bg': "stdbg",
-        'reverse': False,
-    }
+def formatTerminal(inputChunks):
+    colorizeStrings={}
     colorizeString=None
-    for obj in inputObjs:
-        if(type(obj)==dict and obj['op']=='bar'): pass
-        elif(obj==''): pass
-        elif(type(obj)==str):
-            if colorizeString:
-                yield colorizeString
-                colorizeString=None
-            yield obj
-        elif(type(obj)==dict and obj['op']=='colorize'):
-            obj={**obj}
-            if obj['fg']=="stdbg" or obj['bg']=="stdfg":
-                tmp=obj['bg']
-                obj['bg']=obj['fg']
-                obj['fg']=tmp
-                obj['reverse']=True
+    for chunk in inputChunks:
+        out=[]
+        for obj in chunk:
+            if(type(obj)==dict and obj['op']=='bar'): pass
+            elif(obj==''): pass
+            elif(type(obj)==str):
+                if colorizeString:
+                    out.append(colorizeString)
+                    colorizeString=None
+                out.append(obj)
+            elif(type(obj)==dict and obj['op']=='colorize'):
+                key=(obj['fg'], obj['bold'], obj['bg'])
+                colorizeString=colorizeStrings.get(key)
+                if colorizeString:
+                    continue
+                [fg, bold, bg]=key
+                reverse=(fg=="stdbg" or bg=="stdfg")
+                if reverse:
+                    [fg, bg]=[bg, fg]
+                colorizeString=f'\x1b[0'
+                if bold: colorizeString+=';1'
+                if reverse: colorizeString+=';7'
+                if fg!="stdfg":
+                    colorizeString+=';'+{"red": '31;91', "green": '32;92', "magenta": '35', "grey": '90;2;38;5;244;38;2;128;128;128'}[fg]
+                if bg!="stdbg":
+                    colorizeString+=';'+{"red": '41;101', "green": '42;102', "magenta": '45', "grey": '100;2;48;5;244;48;2;128;128;128'}[bg]
+                colorizeString+='m'
+                colorizeStrings[key]=colorizeString
             else:
-                obj['reverse']=False
-            colorizeString=f'\x1b[0'
-            if obj['bold']: colorizeString+=';1'
-            if obj['reverse']: colorizeString+=';7'
-            if obj['fg']!="stdfg":
-                colorizeString+=';'+{"red": '31;91', "green": '32;92', "magenta": '35', "grey": '90;2;38;5;244;38;2;128;128;128'}[obj["fg"]]
-            if obj['bg']!="stdbg":
-                colorizeString+=';'+{"red": '41;101', "green": '42;102', "magenta": '45', "grey": '100;2;48;5;244;48;2;128;128;128'}[obj["bg"]]
-            colorizeString+='m'
-            currentColorization=obj
-        else:
-            die('Weird object in formatTerminal', None)
+                die('Weird object in formatTerminal', None)
+        yield ''.join(out)
 
 def terminalHighlight(inputObjs):
-    yield from formatTerminal(formatDiffHelper(inputObjs, "highlight"))
+    yield from formatTerminal(formatDiffChunks(inputObjs, "highlight"))
 def terminalVisualize(inputObjs):
-    yield from formatTerminal(formatDiffHelper(inputObjs, "visualize"))
+    yield from formatTerminal(formatDiffChunks(inputObjs, "visualize"))
 def formatDiff(inputObjs):
     if sys.stdout.isatty():
         yield from terminalHighlight(inputObjs)
     else:
-        yield from formatDiffHelper(inputObjs, "raw")
+        yield from formatDiffRaw(inputObjs)
 
 def removeSnippets(inputObjs):
     leftsnippetname=''
     rightsnippetname=''
     for obj in inputObjs:
-        op=obj['op']
+        op=obj.op
         if(op=='leftcontent'):
             if(leftsnippetname==''):
                 yield obj
@@ -734,21 +1189,21 @@ def removeSnippets(inputObjs):
             if(leftsnippetname=='' and rightsnippetname==''):
                 yield obj
             elif(leftsnippetname==''):
-                yield {**obj, 'op': 'leftcontent'}
+                yield obj._replace(op='leftcontent')
             elif(rightsnippetname==''):
-                yield {**obj, 'op': 'rightcontent'}
+                yield obj._replace(op='rightcontent')
         elif(op=='ignorecontent'):
             pass
         elif(op=='leftsnippet'):
-            leftsnippetname=obj['name']
+            leftsnippetname=obj.name
         elif(op=='rightsnippet'):
-            rightsnippetname=obj['name']
+            rightsnippetname=obj.name
         elif(op in ['endleftsnippet', 'endrightsnippet']):
             pass
         elif(op=='endhunk' and
            (leftsnippetname!='' or
             rightsnippetname!='')):
-            die('[HDF13] Hunk ended inside named snippet', obj['lineNr'])
+            die('[HDF13] Hunk ended inside named snippet', obj.lineNr)
         elif(op in ['beginfile', 'endfile', 'index', 'labels', 'leftfilemode', 'rightfilemode', 'similarity-index', 'rename', 'beginhunk', 'endhunk']):
             yield obj
         else:
@@ -756,68 +1211,70 @@ def removeSnippets(inputObjs):
 
 headerOps=['index', 'labels', 'leftfilemode', 'rightfilemode', 'similarity-index', 'rename']
 def convertUnprefixedHunksToUnified(inputObjs):
+    # Each buffer holds a list of pieces. A buffer is only joined and split when
+    # a piece containing a newline has been appended to it, so every piece of
+    # content is split at most once.
     state={
-        'leftcontent': '',
-        'rightcontent': '',
-        'bothcontent': '',
+        'leftcontent': [],
+        'rightcontent': [],
+        'bothcontent': [],
         'leftended': False,
         'rightended': False,
     }
+    pendingLines=set()
     def checkInvariants():
         error1 = (state['bothcontent'] and (state['leftcontent'] or state['rightcontent']))
         error2 = (state['leftended'] and (state['leftcontent'] or state['bothcontent']))
         error3 = (state['rightended'] and (state['rightcontent'] or state['bothcontent']))
         if (error1 or error2 or error3):
             die('Broken invariant in convertUnprefixedHunksToUnified', None)
+    def append(var, content):
+        if content:
+            state[var].append(content)
+            if('\n' in content):
+                pendingLines.add(var)
     for obj in inputObjs:
-        if(obj['prefix']):
+        if(obj.prefix):
             yield obj
             continue
-        op=obj['op']
-        content=obj['content'] if op.endswith('content') else None
+        op=obj.op
         checkInvariants()
-        for var in ['leftcontent', 'rightcontent', 'bothcontent']:
-            while('\n' in state[var]):
-                lines=state[var].split('\n')
-                yield {
-                    'op': var,
-                    'prefix': '',
-                    'content': lines[0]+'\n',
-                    'leftsnippetname': '',
-                    'rightsnippetname': '',
-                }
-                state[var]='\n'.join(lines[1:])
+        if pendingLines:
+            for var in ['leftcontent', 'rightcontent', 'bothcontent']:
+                if(var in pendingLines):
+                    lines=''.join(state[var]).split('\n')
+                    for line in lines[:-1]:
+                        yield Content(var, '', line+'\n', '', '', None, None, hunk)
+                    state[var]=[lines[-1]] if lines[-1] else []
+            pendingLines.clear()
         checkInvariants()
         if(op=='beginhunk'):
-            yield {**obj, 'fileformat': 'git', 'hunktype': 'unified'}
+            hunk=obj._replace(fileformat='git', hunktype='unified')
+            yield hunk
         elif(op=='beginfile'):
-            yield {**obj, 'fileformat': 'git'}
+            yield obj._replace(fileformat='git')
         elif(op.endswith('snippet')):
             pass
         elif(op.endswith('content')):
-            l=(op in ['leftcontent', 'bothcontent', 'bothlowprioritycontent'] and not obj['leftsnippetname'])
-            r=(op in ['rightcontent', 'bothcontent', 'bothlowprioritycontent'] and not obj['rightsnippetname'])
+            content=obj.content
+            l=(op in ['leftcontent', 'bothcontent', 'bothlowprioritycontent'] and not obj.leftsnippetname)
+            r=(op in ['rightcontent', 'bothcontent', 'bothlowprioritycontent'] and not obj.rightsnippetname)
             if(state['bothcontent'] and xor(l, r)):
-                state['leftcontent']=state['bothcontent']
+                state['leftcontent']=list(state['bothcontent'])
                 state['rightcontent']=state['bothcontent']
-                state['bothcontent']=''
+                state['bothcontent']=[]
             if(l and r and not (state['leftcontent'] or state['rightcontent'])):
-                state['bothcontent']+=content
+                append('bothcontent', content)
             else:
                 if l:
-                    state['leftcontent']+=content
+                    append('leftcontent', content)
                 if r:
-                    state['rightcontent']+=content
+                    append('rightcontent', content)
         elif(op=='endhunk'):
             for var in ['leftcontent', 'rightcontent', 'bothcontent']:
                 if(state[var]):
-                    yield {
-                        'op': var,
-                        'prefix': '',
-                        'content': state[var],
-                        'crlf': '\n',
-                    }
-                    state[var]=''
+                    yield Content(var, '', ''.join(state[var]), '', '', None, '\n', hunk)
+                    state[var]=[]
                     if(var in ['leftcontent', 'bothcontent']):
                         state['leftended']=True
                     if(var in ['rightcontent', 'bothcontent']):
@@ -837,113 +1294,117 @@ def switchleftright(text):
     if(text.startswith('right')): return 'left'+text[5:]
     return text
 
-def reverse(inputObjs):
+def reverseDiff(inputObjs):
     for obj in inputObjs:
-        op=obj['op']
-        if(m(r'^(left|right).*$', op)):
-            yield {**obj, 'op': switchleftright(op)}
-        else:
-            sendobj={}
-            for key in obj:
-                sendobj[switchleftright(key)] = obj[key]
-            yield sendobj
+        sendobj={}
+        for key, value in zip(obj._fields, obj):
+            sendobj[switchleftright(key)] = value
+        sendobj['op'] = switchleftright(obj.op)
+        yield type(obj)(**sendobj)
 
-def validateSnippets(inputObjs):
-    snippetcache={}
+def validateSnippets(inputObjs, snippetcache=None):
+    # Maps each snippet name to the digest of its content and the line number
+    # of its first use. A dict can be passed in to see the first uses
+    # afterwards.
+    if snippetcache is None:
+        snippetcache={}
     for obj in inputObjs:
-        op=obj['op']
+        op=obj.op
         if(op in ['endleftsnippet', 'endrightsnippet']):
-            name=obj['name']
-            content=obj['content']
-            if(name in snippetcache and snippetcache[name]!=content):
-                die(f"[HDF15] Content of snippet '{name}' did not match previous use", obj['lineNr'])
-            snippetcache[name]=content
+            name=obj.name
+            digest=obj.digest
+            if(name not in snippetcache):
+                snippetcache[name]=(digest, obj.lineNr)
+            elif(snippetcache[name][0]!=digest):
+                raise snippetMismatchError(name, obj.lineNr)
         yield obj
 
+def snippetMismatchError(name, lineNr):
+    return DiffFormatError(f"[HDF15] Content of snippet '{name}' did not match previous use", [lineNr])
+
 def groupHunks(inputObjs):
     for obj in inputObjs:
-        if(obj['op']=='beginhunk'):
+        if(obj.op=='beginhunk'):
             beginHunk=obj
             contents=[]
             endHunk=None
             while True:
                 contentObj=nextOrDie(inputObjs, 'Unexpected generator end in groupHunks', None)
-                if(contentObj['prefix']!=beginHunk['prefix']):
-                    die('[HDF31] Prefix mismatch', contentObj['lineNr'])
-                if(contentObj['op']=='endhunk'):
+                if(contentObj.prefix!=beginHunk.prefix):
+                    die('[HDF31] Prefix mismatch', contentObj.lineNr)
+                if(contentObj.op=='endhunk'):
                     endHunk=contentObj
                     break
                 contents.append(contentObj)
-            yield {**beginHunk, 'op': 'hunk', 'contents': contents, 'endhunk': endHunk}
+            yield Hunk(*beginHunk._replace(op='hunk'), contents, endHunk)
         else:
             yield obj
 
 def ungroupHunks(inputObjs):
     for obj in inputObjs:
-        if(obj['op']=='hunk'):
-            beginHunk={**obj, 'op': 'beginhunk'}
-            del beginHunk['contents']
-            del beginHunk['endhunk']
+        if(obj.op=='hunk'):
+            beginHunk=BeginHunk(*obj[:len(BeginHunk._fields)])._replace(op='beginhunk')
             yield beginHunk
-            prefix=beginHunk['prefix']
-            for contentObj in obj['contents']:
-                yield {**contentObj, 'prefix': prefix}
-            yield {**obj['endhunk'], 'prefix': prefix}
+            prefix=beginHunk.prefix
+            for contentObj in obj.contents:
+                yield contentObj if contentObj.prefix==prefix else contentObj._replace(prefix=prefix)
+            endHunk=obj.endhunk
+            yield endHunk if endHunk.prefix==prefix else endHunk._replace(prefix=prefix)
         else:
             yield obj
 
 def groupFiles(inputObjs):
     for obj in inputObjs:
-        if(obj['op']=='beginfile'):
+        if(obj.op=='beginfile'):
             beginFile=obj
             contents=[]
             while True:
                 contentObj=nextOrDie(inputObjs, 'Unexpected generator end in groupFiles', None)
-                if(contentObj['prefix']!=beginFile['prefix']):
-                    die('[HDF31] Prefix mismatch', contentObj['lineNr'])
-                if(contentObj['op']=='endfile'):
+                if(contentObj.prefix!=beginFile.prefix):
+                    die('[HDF31] Prefix mismatch', contentObj.lineNr)
+                if(contentObj.op=='endfile'):
                     break
                 contents.append(contentObj)
-            yield {**beginFile, 'op': 'file', 'contents': contents}
+            yield File(*beginFile._replace(op='file'), contents)
         else:
             yield obj
 
 def ungroupFiles(inputObjs):
     for obj in inputObjs:
-        if(obj['op']=='file'):
-            beginFile={**obj, 'op': 'beginfile'}
-            del beginFile['contents']
+        if(obj.op=='file'):
+            beginFile=BeginFile(*obj[:len(BeginFile._fields)])._replace(op='beginfile')
             yield beginFile
-            prefix=beginFile['prefix']
-            fileFormat=beginFile['fileformat']
-            for contentObj in obj['contents']:
-                yield {**contentObj, 'prefix': prefix, 'fileformat': fileFormat}
-            yield {'op': 'endfile', 'prefix': prefix}
+            prefix=beginFile.prefix
+            fileFormat=beginFile.fileformat
+            for contentObj in obj.contents:
+                if(contentObj.op=='hunk' and contentObj.fileformat!=fileFormat):
+                    contentObj=contentObj._replace(fileformat=fileFormat)
+                yield contentObj if contentObj.prefix==prefix else contentObj._replace(prefix=prefix)
+            yield EndFile('endfile', prefix, beginFile.filekey, None)
         else:
             yield obj
 
 def duplicateFilesForCompat(inputObjs):
     for obj in inputObjs:
-        if(obj['op']!='file'):
-            die(f'duplicateFilesForCompat expects only file objects, got unexpected {obj["op"]}', None)
-        if(obj['prefix']):
+        if(obj.op!='file'):
+            die(f'duplicateFilesForCompat expects only file objects, got unexpected {obj.op}', None)
+        if(obj.prefix):
             die('duplicateFilesForCompat expects only unprefixed files', None)
-        yield {**obj, 'prefix': '|', 'fileformat': 'hintful'}
-        yield {**obj, 'fileformat': 'git'}
+        yield obj._replace(prefix='|', fileformat='hintful')
+        yield obj._replace(fileformat='git')
 
 def convertHunksToHintful(inputObjs, onlyPrefixed=False):
     for obj in inputObjs:
-        if(obj['op']=='beginfile' and (not onlyPrefixed or obj['prefix'])):
-            yield {**obj, 'fileformat': 'hintful'}
-        elif(obj['op']=='hunk' and (not onlyPrefixed or obj['prefix'])):
-            hunklinecount = len(obj['contents'])
-            yield {
-                **obj,
-                'fileformat': 'hintful',
-                'hunklinecount': hunklinecount,
-                'hunklinecountraw': str(hunklinecount),
-                'hunktype': 'hintful'
-            }
+        if(obj.op=='beginfile' and (not onlyPrefixed or obj.prefix)):
+            yield obj._replace(fileformat='hintful')
+        elif(obj.op=='hunk' and (not onlyPrefixed or obj.prefix)):
+            hunklinecount = sum(type(contentObj)!=Content or not contentObj.partial for contentObj in obj.contents)
+            yield obj._replace(
+                fileformat='hintful',
+                hunklinecount=hunklinecount,
+                hunklinecountraw=str(hunklinecount),
+                hunktype='hintful',
+            )
         else:
             yield obj
 def convertPrefixedHunksToHintful(inputObjs):
@@ -951,43 +1412,56 @@ def convertPrefixedHunksToHintful(inputObjs):
 
 def removeEverythingPrefixed(inputObjs):
     for obj in inputObjs:
-        if not obj['prefix']:
+        if not obj.prefix:
             yield obj
 
+def contentDigest(content):
+    # A fixed-size stand-in for content, used where content only needs to be
+    # compared for equality
+    return hashlib.blake2b(content.encode('latin1'), digest_size=16).digest()
+
 def validateFilesAndHunks(inputObjs):
+    # State is dropped as soon as it can no longer be needed. Any file
+    # comparison following an unprefixed one with the same key is an error, so
+    # once an unprefixed file comparison has ended only its line number is
+    # kept, along with whatever its prefixed counterpart left for the final
+    # checks. Duplicate hunks are always first prefixed, so only the content
+    # of prefixed hunks is kept, as digests.
     state={}
     fileCache={}
     hunkCache={}
     endHunkCache={}
     indexCache={}
     labelsCache={}
-    lastHunk={}
+    fileHunkKeys=[]
+    lastHunk=None
     for obj in inputObjs:
-        op=obj['op']
+        op=obj.op
         if(op=='beginfile'):
             state['leftallowed']=True
             state['rightallowed']=True
-            k=obj['filekey']
+            k=obj.filekey
             if k in fileCache:
-                oldObj=fileCache[k]
-                if not oldObj['prefix'] or obj['prefix']:
-                    die('[HDF33] Duplicate files can only be first a prefixed and then an unprefixed.', [oldObj['lineNr'], obj['lineNr']])
-            fileCache[k]=obj
+                [oldPrefix, oldLineNr]=fileCache[k]
+                if not oldPrefix or obj.prefix:
+                    die('[HDF33] Duplicate files can only be first a prefixed and then an unprefixed.', [oldLineNr, obj.lineNr])
+            fileCache[k]=(obj.prefix, obj.lineNr)
+            fileHunkKeys=[]
         if(op=='index'):
-            k=obj['filekey']
+            k=obj.filekey
             if k in indexCache:
                 oldObj=indexCache[k]
-                if (oldObj['left'], oldObj['right'], oldObj['mode'])!=(obj['left'], obj['right'], obj['mode']):
-                    die('[HDF35] `index` line mismatch between prefixed and unprefixed file', [oldObj['lineNr'], obj['lineNr']])
+                if (oldObj.left, oldObj.right, oldObj.mode)!=(obj.left, obj.right, obj.mode):
+                    die('[HDF35] `index` line mismatch between prefixed and unprefixed file', [oldObj.lineNr, obj.lineNr])
             indexCache[k]=obj
         if(op=='labels'):
-            k=obj['filekey']
+            k=obj.filekey
             if k in labelsCache:
                 oldObj=labelsCache[k]
-                if oldObj['left']!=obj['left']:
-                    die('[HDF35] `---` line mismatch between prefixed and unprefixed file', [oldObj['lineNr'], obj['lineNr']])
-                if oldObj['right']!=obj['right']:
-                    die('[HDF35] `+++` line mismatch between prefixed and unprefixed file', [oldObj['lineNr']+1, obj['lineNr']+1])
+                if oldObj.left!=obj.left:
+                    die('[HDF35] `---` line mismatch between prefixed and unprefixed file', [oldObj.lineNr, obj.lineNr])
+                if oldObj.right!=obj.right:
+                    die('[HDF35] `+++` line mismatch between prefixed and unprefixed file', [oldObj.lineNr+1, obj.lineNr+1])
             labelsCache[k]=obj
         if(op=='beginhunk'):
             for side in ['left', 'right']:
@@ -995,55 +1469,70 @@ def validateFilesAndHunks(inputObjs):
                     # If a hunk has ended without a newline on either side, the hunk must be positioned at end of file for that side.
                     # Since all further content on the other side is necessarily changed, the hunk must be positioned at end of file for both sides.
                     # Hence, it must be the last hunk in the current file comparison.
-                    die(f'[HDF18] New hunk following a hunk ending without newline on {side} side', obj['lineNr'])
-            if(not ((obj['fileformat']=='hintful' and (obj['hunktype']=='hintful' or obj['hunktype']=='unified')) or
-                    (obj['fileformat']=='git' and obj['hunktype']=='unified'))):
-                die(f"[HDF23] Illegal combination of fileformat={obj['fileformat']}, hunktype={obj['hunktype']}", obj['lineNr'])
-            k=obj['hunkkey']
+                    die(f'[HDF18] New hunk following a hunk ending without newline on {side} side', obj.lineNr)
+            if(not ((obj.fileformat=='hintful' and (obj.hunktype=='hintful' or obj.hunktype=='unified')) or
+                    (obj.fileformat=='git' and obj.hunktype=='unified'))):
+                die(f"[HDF23] Illegal combination of fileformat={obj.fileformat}, hunktype={obj.hunktype}", obj.lineNr)
+            k=obj.hunkkey
             if k in hunkCache:
-                oldObj=hunkCache[k]
-                if not oldObj['prefix'] or obj['prefix']:
-                    die('Duplicate hunks can only be first a prefixed and then an unprefixed.', [oldObj['lineNr'], obj['lineNr']])
-            hunkCache[k]=obj
-            if lastHunk and lastHunk['filekey']==obj['filekey'] and lastHunk['prefix']==obj['prefix']:
+                [oldPrefix, oldLineNr]=hunkCache[k]
+                if not oldPrefix or obj.prefix:
+                    die('Duplicate hunks can only be first a prefixed and then an unprefixed.', [oldLineNr, obj.lineNr])
+            hunkCache[k]=(obj.prefix, obj.lineNr)
+            fileHunkKeys.append(k)
+            if lastHunk and lastHunk.filekey==obj.filekey and lastHunk.prefix==obj.prefix:
                 for side in ['left', 'right']:
-                    if not lastHunk[f'{side}startline']+lastHunk[f'{side}linecount']<=obj[f'{side}startline']:
-                        die(f'[HDF24] Hunk begins on {side} side before the previous one ended', obj['lineNr'])
+                    if not getattr(lastHunk, f'{side}startline')+getattr(lastHunk, f'{side}linecount')<=getattr(obj, f'{side}startline'):
+                        die(f'[HDF24] Hunk begins on {side} side before the previous one ended', obj.lineNr)
             lastHunk=obj
         if(op=='endhunk'):
-            k=obj['hunkkey']
-            beginhunk=hunkCache[k]
+            k=obj.hunkkey
+            beginhunk=obj.hunk
+            prefixedDigests=endHunkCache.pop(k, None)
+            digests={}
             for side in ['left', 'right']:
-                if k in endHunkCache:
-                    if endHunkCache[k][f'{side}content']!=obj[f'{side}content']:
-                        die(f'[HDF37] Content mismatch on {side} side in duplicate hunk', obj['lineNr'])
-                content=obj[f'{side}content']
-                nonl=content and not content.endswith('\n')
+                if(obj.prefix or prefixedDigests):
+                    digests[side]=obj.sideDigest(side)
+                if prefixedDigests:
+                    if prefixedDigests[side]!=digests[side]:
+                        die(f'[HDF37] Content mismatch on {side} side in duplicate hunk', obj.lineNr)
+                [linecount, nonl]=obj.sideLineCount(side)
                 if(nonl):
                     state[f'{side}allowed']=False
-                linecount = len(content.split('\n')) - (0 if nonl else 1)
-                if(linecount!=beginhunk[f'{side}linecount']):
-                    die(f"[HDF11] Line count on {side} side declared as {beginhunk[f'{side}linecount']} but is really {linecount}", [beginhunk['lineNr'], obj['lineNr']])
-            endHunkCache[k]=obj
+                if(linecount!=getattr(beginhunk, f'{side}linecount')):
+                    die(f"[HDF11] Line count on {side} side declared as {getattr(beginhunk, f'{side}linecount')} but is really {linecount}", [beginhunk.lineNr, obj.lineNr])
+            if(obj.prefix):
+                endHunkCache[k]=digests
+        if(op=='endfile' and not obj.prefix):
+            k=obj.filekey
+            for hunkKey in fileHunkKeys:
+                del hunkCache[hunkKey]
+            if k in indexCache and not indexCache[k].prefix:
+                del indexCache[k]
+            if k in labelsCache and not labelsCache[k].prefix:
+                del labelsCache[k]
+            fileHunkKeys=[]
         yield obj
     for fileKey in fileCache:
-        if(fileCache[fileKey]['prefix']):
-            die('[HDF32] Prefixed file comparison not followed by unprefixed file comparison', fileCache[fileKey]['lineNr'])
+        [prefix, lineNr]=fileCache[fileKey]
+        if(prefix):
+            die('[HDF32] Prefixed file comparison not followed by unprefixed file comparison', lineNr)
     for hunkKey in hunkCache:
-        if(hunkCache[hunkKey]['prefix']):
-            die('[HDF36] Prefixed hunk not followed by unprefixed hunk', hunkCache[hunkKey]['lineNr'])
+        [prefix, lineNr]=hunkCache[hunkKey]
+        if(prefix):
+            die('[HDF36] Prefixed hunk not followed by unprefixed hunk', lineNr)
     for fileKey in indexCache:
-        if(indexCache[fileKey]['prefix']):
-            die('[HDF34] `index` line present for prefixed file but missing for unprefixed file', [indexCache[fileKey]['lineNr'], fileCache[fileKey]['lineNr']])
+        if(indexCache[fileKey].prefix):
+            die('[HDF34] `index` line present for prefixed file but missing for unprefixed file', [indexCache[fileKey].lineNr, fileCache[fileKey][1]])
     for fileKey in labelsCache:
-        if(labelsCache[fileKey]['prefix']):
+        if(labelsCache[fileKey].prefix):
             die('[HDF34] `---` and `+++` lines present for prefixed file but missing for unprefixed file',
-                [labelsCache[fileKey]['lineNr'], labelsCache[fileKey]['lineNr']+1, fileCache[fileKey]['lineNr']])
+                [labelsCache[fileKey].lineNr, labelsCache[fileKey].lineNr+1, fileCache[fileKey][1]])
 
 def assertNoUnprefixedHintfulFileComparisons(inputObjs, msg):
     for obj in inputObjs:
-        if(obj['op']=='beginfile' and not obj['prefix'] and obj['fileformat']=='hintful'):
-            die(msg, obj['lineNr'])
+        if(obj.op=='beginfile' and not obj.prefix and obj.fileformat=='hintful'):
+            die(msg, obj.lineNr)
         yield obj
 def assertNoUnprefixedHintfulFileComparisonsInCompat(inputObjs):
     yield from assertNoUnprefixedHintfulFileComparisons(inputObjs, '[HDF41] Unexpected unprefixed hintful file comparison in compat diff file')
@@ -1051,61 +1540,947 @@ def assertNoUnprefixedHintfulFileComparisonsInUnified(inputObjs):
     yield from assertNoUnprefixedHintfulFileComparisons(inputObjs, '[HDF21] Unexpected unprefixed hintful file comparison in unified diff file')
 
 def applyPrefixedFiles(inputObjs):
-    fileCache={}
+    # Unprefixed file comparisons are passed on as they come, except that a
+    # hunk with a prefixed version is replaced by that version, and a file
+    # comparison with a prefixed version takes its file format. Only prefixed
+    # hunks are kept, each until its unprefixed version has been seen.
+    prefixedFiles={}
     def hunkKey(hunk):
         return (
-            hunk['leftstartline'],
-            hunk['leftlinecount'],
-            hunk['rightstartline'],
-            hunk['rightlinecount'],
+            hunk.leftstartline,
+            hunk.leftlinecount,
+            hunk.rightstartline,
+            hunk.rightlinecount,
         )
+    fileFormat=None
+    prefixedHunks={}
+    hunkEvents=None
+    replacing=False
     for obj in inputObjs:
-        op=obj['op']
-        if not op=='file':
-            die('Weird object in applyPrefixedFiles', None)
-        fileKey=(obj['leftfile'], obj['rightfile'])
-        if(obj['prefix']):
-            fileCache[fileKey]=obj
-            continue
-        if(fileKey in fileCache):
-            oldFile=obj
-            appliedFile=fileCache[fileKey]
-            hunkCache={}
-            for hunkObj in appliedFile['contents']:
-                op2=hunkObj['op']
-                if(op2=='hunk'): hunkCache[hunkKey(hunkObj)]=hunkObj
-                elif(op2 in headerOps): pass
-                else: die(f'Unexpected op {op2} in applyPrefixedFiles', None)
-            newContents=[]
-            for hunkObj in oldFile['contents']:
-                op2=hunkObj['op']
-                if(op2=='hunk' and hunkKey(hunkObj) in hunkCache): newContents.append(hunkCache[hunkKey(hunkObj)])
-                elif(op2 in ['hunk', *headerOps]): newContents.append(hunkObj)
-                else: die(f'Unexpected op {op2} in applyPrefixedFiles', None)
-            yield {
-                **oldFile,
-                'fileformat': appliedFile['fileformat'],
-                'contents': newContents
-            }
+        op=obj.op
+        if(obj.prefix):
+            if(op=='beginfile'):
+                fileHunks={}
+                prefixedFiles[obj.filekey]=(obj.fileformat, fileHunks)
+            elif(op=='beginhunk'):
+                hunkEvents=[obj]
+                fileHunks[hunkKey(obj)]=hunkEvents
+            elif(op in ['endfile', *headerOps]):
+                pass
+            else:
+                hunkEvents.append(obj)
             continue
-        yield obj
+        if(op=='beginfile'):
+            [fileFormat, prefixedHunks]=prefixedFiles.pop(obj.filekey, (obj.fileformat, {}))
+            yield obj if obj.fileformat==fileFormat else obj._replace(fileformat=fileFormat)
+        elif(op=='beginhunk'):
+            appliedHunk=prefixedHunks.pop(hunkKey(obj), None)
+            replacing=appliedHunk is not None
+            if replacing:
+                yield appliedHunk[0]._replace(prefix='', fileformat=fileFormat)
+                for hunkObj in appliedHunk[1:]:
+                    yield hunkObj._replace(prefix='')
+            else:
+                yield obj if obj.fileformat==fileFormat else obj._replace(fileformat=fileFormat)
+        elif(replacing):
+            # The unprefixed version of a replaced hunk is dropped
+            if(op=='endhunk'):
+                replacing=False
+        elif(op in ['endhunk', 'endfile', *headerOps] or op.endswith('content') or op.endswith('snippet')):
+            yield obj
+        else:
+            die(f'Unexpected op {op} in applyPrefixedFiles', None)
+
+# Output is gathered into blocks of at least this many characters before it is
+# written, which can be changed with the HINTFUL_DIFF_OUTPUT_BUFFER_SIZE
+# environment variable.
+outputBufferSize=int(os.environ.get('HINTFUL_DIFF_OUTPUT_BUFFER_SIZE', 1<<16))
+def writeBlocks(inputStrings, write):
+    pending=[]
+    pendingSize=0
+    try:
+        for text in inputStrings:
+            pending.append(text)
+            pendingSize+=len(text)
+            if(pendingSize>=outputBufferSize):
+                write(''.join(pending).encode('latin1'))
+                pending=[]
+                pendingSize=0
+    finally:
+        # Also reached when die() raises because of invalid input further on
+        write(''.join(pending).encode('latin1'))
 
 def output(inputStrings):
-    for text in inputStrings:
-        print(text, sep='', end='')
+    sys.stdout.flush()
+    try:
+        try:
+            writeBlocks(inputStrings, sys.stdout.buffer.write)
+        finally:
+            sys.stdout.buffer.flush()
+    except BrokenPipeError:
+        # The reader went away, e.g. `head` exited early. Point stdout at
+        # /dev/null so that flushing it at exit does not fail once more.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
 
 def sink(inputObjs):
     for __ignored in inputObjs:
         pass
 
-def getProcStack():
+# Applying a diff to a directory, used as the last stage of the apply commands.
+# Each file comparison is collected into a FilePatch holding the effective left
+# and right content of each hunk, and the patched file is first written to a
+# temporary file. Only once the whole diff has been read without error are the
+# temporary files moved into place, so that a diff that does not apply leaves
+# the directory as it was.
+FilePatch = namedtuple('FilePatch', 'source dest created deleted mode hunks lineNr')
+def stripPathComponent(path, lineNr):
+    # Like `patch -p1`, and refusing paths that could point outside the directory
+    parts=path.split('/')
+    if(len(parts)<2 or not all(parts[1:]) or '.' in parts[1:] or '..' in parts[1:]):
+        die(f"Cannot apply to path {path}", lineNr)
+    return '/'.join(parts[1:])
+
+def collectFilePatches(inputObjs):
+    patch=None
+    for obj in inputObjs:
+        op=obj.op
+        if(obj.prefix):
+            die(f'collectFilePatches expects only unprefixed objects, got prefixed {op}', None)
+        if(op=='beginfile'):
+            patch=FilePatch(
+                source=stripPathComponent(obj.leftfile, obj.lineNr),
+                dest=stripPathComponent(obj.rightfile, obj.lineNr),
+                created=False,
+                deleted=False,
+                mode=None,
+                hunks=[],
+                lineNr=obj.lineNr,
+            )
+        elif(op=='labels'):
+            if(obj.left=='/dev/null'):
+                patch=patch._replace(created=True)
+            if(obj.right=='/dev/null'):
+                patch=patch._replace(deleted=True)
+        elif(op=='leftfilemode'):
+            patch=patch._replace(deleted=True)
+        elif(op=='rightfilemode'):
+            patch=patch._replace(created=True, mode=int(obj.mode, 8) & 0o7777)
+        elif(op=='endhunk'):
+            hunk=obj.hunk
+            patch.hunks.append((
+                hunk.leftstartline,
+                hunk.leftlinecount,
+                obj.leftcontent.encode('latin1'),
+                obj.rightcontent.encode('latin1'),
+                hunk.lineNr,
+            ))
+        elif(op=='endfile'):
+            if(patch.created and patch.deleted):
+                die(f'File comparison for {patch.dest} both creates and deletes it', patch.lineNr)
+            yield patch
+            patch=None
+        elif(op in headerOps or op in ['beginhunk', 'endleftsnippet', 'endrightsnippet'] or op.endswith('content') or op.endswith('snippet')):
+            pass
+        else:
+            die(f'collectFilePatches cannot process operation {op}', None)
+
+def skipLines(data, pos, count, patch, lineNr):
+    for _ in range(count):
+        end=data.find(b'\n', pos)
+        if(0<=end):
+            pos=end+1
+        elif(pos<len(data)):
+            pos=len(data)
+        else:
+            die(f'Hunk does not apply to {patch.source}: File has too few lines', lineNr)
+    return pos
+
+def patchContent(data, patch, write):
+    # Hunks refer to line numbers of the unpatched file, so each hunk replaces
+    # a run of lines found by counting from the end of the previous hunk.
+    # Unchanged runs are written as views of data.
+    with memoryview(data) as view:
+        pos=0
+        nextLine=1
+        for [leftstartline, leftlinecount, left, right, lineNr] in patch.hunks:
+            firstLine=leftstartline if leftlinecount else leftstartline+1
+            if(firstLine<nextLine):
+                die(f'Hunk overlaps the previous hunk for {patch.source}', lineNr)
+            start=skipLines(data, pos, firstLine-nextLine, patch, lineNr)
+            end=skipLines(data, start, leftlinecount, patch, lineNr)
+            if(view[start:end]!=left):
+                die(f'Hunk does not apply to {patch.source}: Content does not match', lineNr)
+            write(view[pos:start])
+            write(right)
+            pos=end
+            nextLine=firstLine+leftlinecount
+        write(view[pos:])
+
+def patchFile(directory, check, patch):
+    # Returns the patch along with the path of a temporary file holding the
+    # patched content, or None if there is nothing to move into place
+    sourcePath=os.path.join(directory, patch.source)
+    if(patch.created):
+        f=None
+        data=b''
+        mode=patch.mode if patch.mode is not None else 0o644
+    else:
+        try:
+            f=open(sourcePath, 'rb')
+            st=os.fstat(f.fileno())
+        except OSError as e:
+            die(f'Cannot apply to {patch.source}: {e.strerror}', patch.lineNr)
+        if not stat.S_ISREG(st.st_mode):
+            f.close()
+            die(f'Cannot apply to {patch.source}: Not a regular file', patch.lineNr)
+        data=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b''
+        mode=stat.S_IMODE(st.st_mode)
+    try:
+        if(check or patch.deleted):
+            written=[0]
+            def write(block):
+                written[0]+=len(block)
+            patchContent(data, patch, write)
+            if(patch.deleted and written[0]):
+                die(f'Hunks do not delete all of {patch.source}', patch.lineNr)
+            return patch, None
+        parent=os.path.dirname(os.path.join(directory, patch.dest))
+        [fd, tempPath]=tempfile.mkstemp(prefix='.apply-', dir=parent if os.path.isdir(parent) else directory)
+        try:
+            with open(fd, 'wb') as out:
+                patchContent(data, patch, out.write)
+                os.fchmod(out.fileno(), mode)
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+        return patch, tempPath
+    finally:
+        if f:
+            if(type(data)==mmap.mmap):
+                data.close()
+            f.close()
+
+def tryPatchFile(directory, check, patch):
+    # Used in worker processes, where an error would also lose the results for
+    # the other files sent along in the same chunk
+    try:
+        return patchFile(directory, check, patch), None
+    except Exception as e:
+        return (patch, None), e
+
+def commitPatches(directory, results):
+    # Files that are deleted or renamed away are removed before the patched
+    # files are moved into place, so that files can swap names
+    dests={patch.dest for patch, tempPath in results if tempPath}
+    for patch, tempPath in results:
+        if(patch.deleted or (patch.source!=patch.dest and patch.source not in dests)):
+            os.unlink(os.path.join(directory, patch.source))
+            parent=os.path.dirname(patch.source)
+            while parent:
+                try:
+                    os.rmdir(os.path.join(directory, parent))
+                except OSError:
+                    break
+                parent=os.path.dirname(parent)
+    for patch, tempPath in results:
+        if tempPath:
+            destPath=os.path.join(directory, patch.dest)
+            os.makedirs(os.path.dirname(destPath), exist_ok=True)
+            os.replace(tempPath, destPath)
+
+def applyDiff(inputObjs, directory='.', check=False, jobs=1):
+    # With jobs, file comparisons are patched in a pool of worker processes.
+    # Nothing is changed in check mode, but the diff must apply all the same.
+    work=functools.partial(patchFile, directory, check)
+    results=[]
+    dests=set()
+    errors=[]
+    def take(result):
+        results.append(result)
+        patch=result[0]
+        if(patch.dest in dests):
+            errors.append(DiffFormatError(f'More than one file comparison for {patch.dest}', [patch.lineNr]))
+        dests.add(patch.dest)
+    try:
+        if(1<jobs):
+            with multiprocessing.get_context('fork').Pool(jobs) as pool:
+                # Results are still taken after an error, so that every
+                # temporary file is removed
+                for result, error in pool.imap(functools.partial(tryPatchFile, directory, check), collectFilePatches(inputObjs), 16):
+                    take(result)
+                    if error:
+                        errors.append(error)
+        else:
+            for patch in collectFilePatches(inputObjs):
+                take(work(patch))
+                if errors:
+                    break
+        if errors:
+            raise errors[0]
+        # A file can only be created where the diff removes one, if anywhere
+        removed={patch.source for patch, tempPath in results if patch.deleted or patch.source!=patch.dest}
+        for patch, tempPath in results:
+            if((patch.created or patch.source!=patch.dest) and patch.dest not in removed and os.path.lexists(os.path.join(directory, patch.dest))):
+                die(f'Cannot create {patch.dest}: File exists', patch.lineNr)
+        if not check:
+            commitPatches(directory, results)
+    finally:
+        for patch, tempPath in results:
+            if(tempPath and os.path.lexists(tempPath)):
+                os.unlink(tempPath)
+
+# Generating diffs, used by the diff-hintful command. Two files or the files
+# of two directories are compared line by line, and each changed region is
+# then compared again token by token, so that hunks show which parts of the
+# lines changed. Sequences are compared by anchoring on elements that occur
+# exactly once on both sides, like patience diff, and the regions between
+# anchors without such elements are compared with Myers' O(ND) algorithm.
+contextLines = 3
+# Regions needing more edits than this are not searched for a shortest edit
+# script, but replaced as a whole
+myersMaxCost = 1000
+def uniqueAnchors(a, alo, ahi, b, blo, bhi):
+    # Returns the longest increasing sequence of pairs of indices of elements
+    # occurring exactly once in each range
+    indexInA={}
+    for i in range(alo, ahi):
+        indexInA[a[i]]=-1 if a[i] in indexInA else i
+    indexInB={}
+    for j in range(blo, bhi):
+        if(0<=indexInA.get(b[j], -1)):
+            indexInB[b[j]]=-1 if b[j] in indexInB else j
+    pairs=sorted((j, indexInA[x]) for x, j in indexInB.items() if 0<=j)
+    # Patience sorting on the indices in a, in the order of b
+    tops=[]
+    tails=[]
+    back={}
+    for j, i in pairs:
+        pile=bisect.bisect_left(tops, i)
+        back[i]=(tails[pile-1] if pile else None)
+        if(pile==len(tops)):
+            tops.append(i)
+            tails.append((i, j))
+        else:
+            tops[pile]=i
+            tails[pile]=(i, j)
+    anchors=[]
+    anchor=tails[-1] if tails else None
+    while anchor:
+        anchors.append(anchor)
+        anchor=back[anchor[0]]
+    anchors.reverse()
+    return anchors
+
+def myersMatches(a, alo, ahi, b, blo, bhi, matches):
+    n=ahi-alo
+    m=bhi-blo
+    # trace[d] maps each diagonal k to the furthest x reached with d edits
+    trace=[]
+    prev={1: 0}
+    done=False
+    for d in range(min(n+m, myersMaxCost)+1):
+        cur={}
+        for k in range(-d, d+1, 2):
+            if(k==-d or (k!=d and prev[k-1]<prev[k+1])):
+                x=prev[k+1]
+            else:
+                x=prev[k-1]+1
+            y=x-k
+            while(x<n and y<m and a[alo+x]==b[blo+y]):
+                x+=1
+                y+=1
+            cur[k]=x
+            if(n<=x and m<=y):
+                done=True
+                break
+        trace.append(cur)
+        if done:
+            break
+        prev=cur
+    if not done:
+        return
+    # Follow the edits back from the end, keeping the diagonal runs
+    x=n
+    y=m
+    for d in range(len(trace)-1, 0, -1):
+        prev=trace[d-1]
+        k=x-y
+        if(k==-d or (k!=d and prev[k-1]<prev[k+1])):
+            prevk=k+1
+            startx=prev[prevk]
+        else:
+            prevk=k-1
+            startx=prev[prevk]+1
+        if(startx<x):
+            matches.append((alo+startx, blo+startx-k, x-startx))
+        x=prev[prevk]
+        y=x-prevk
+    if(0<x):
+        matches.append((alo, blo, x))
+
+def findMatches(a, b):
+    # Returns the matching runs of a and b as sorted (i, j, size) triples
+    matches=[]
+    regions=[(0, len(a), 0, len(b))]
+    while regions:
+        [alo, ahi, blo, bhi]=regions.pop()
+        size=0
+        while(alo+size<ahi and blo+size<bhi and a[alo+size]==b[blo+size]):
+            size+=1
+        if size:
+            matches.append((alo, blo, size))
+            alo+=size
+            blo+=size
+        size=0
+        while(alo<ahi-size and blo<bhi-size and a[ahi-size-1]==b[bhi-size-1]):
+            size+=1
+        if size:
+            matches.append((ahi-size, bhi-size, size))
+            ahi-=size
+            bhi-=size
+        if(alo==ahi or blo==bhi):
+            continue
+        anchors=uniqueAnchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for [i, j] in anchors:
+                regions.append((alo, i, blo, j))
+                matches.append((i, j, 1))
+                alo=i+1
+                blo=j+1
+            regions.append((alo, ahi, blo, bhi))
+        else:
+            myersMatches(a, alo, ahi, b, blo, bhi, matches)
+    matches.sort()
+    merged=[]
+    for match in matches:
+        if(merged and merged[-1][0]+merged[-1][2]==match[0] and merged[-1][1]+merged[-1][2]==match[1]):
+            merged[-1]=(merged[-1][0], merged[-1][1], merged[-1][2]+match[2])
+        else:
+            merged.append(match)
+    return merged
+
+def internAll(*sequences):
+    # Replaces equal elements with equal small integers, which compare faster
+    ids={}
+    return [[ids.setdefault(x, len(ids)) for x in sequence] for sequence in sequences]
+
+def formatContent(opchar, text, out):
+    # Appends hintful content lines for text. A line ending in a newline is
+    # written with the `$` marker followed by the newline and any CRs before
+    # it, other text with the `\` marker.
+    for linem in contentLinePattern.finditer(text):
+        [content, crlf]=linem.group(1, 2)
+        if crlf:
+            out.append(f'{opchar}{content}${crlf}')
+        elif content:
+            out.append(f'{opchar}{content}\\\n')
+
+contentLinePattern = re.compile(r'([^\n]*?)(\r*\n|$)')
+wordPattern = re.compile(r'\r*\n|\w+|[ \t]+|.')
+def formatChange(leftText, rightText, out):
+    # Compares the tokens of a changed region. If too little of the text is
+    # left unchanged, the lines are shown as removed and added instead.
+    if(leftText and rightText):
+        leftTokens=wordPattern.findall(leftText)
+        rightTokens=wordPattern.findall(rightText)
+        [leftIds, rightIds]=internAll(leftTokens, rightTokens)
+        matches=findMatches(leftIds, rightIds)
+        def visibleLength(tokens):
+            return sum(len(token) for token in tokens if not token.isspace())
+        unchanged=sum(visibleLength(leftTokens[i:i+size]) for [i, _, size] in matches)
+        if(visibleLength(leftTokens)+visibleLength(rightTokens)<=4*unchanged):
+            i=0
+            j=0
+            for [mi, mj, size] in [*matches, (len(leftTokens), len(rightTokens), 0)]:
+                formatContent('-', ''.join(leftTokens[i:mi]), out)
+                formatContent('+', ''.join(rightTokens[j:mj]), out)
+                formatContent(' ', ''.join(leftTokens[mi:mi+size]), out)
+                i=mi+size
+                j=mj+size
+            return
+    formatContent('-', leftText, out)
+    formatContent('+', rightText, out)
+
+def hunkRange(start, count):
+    # Like unified diff, a range of no lines starts at the line before it
+    if(count==1):
+        return f'{start+1}'
+    return f'{start+1 if count else start},{count}'
+
+def formatHunks(leftLines, rightLines):
+    [leftIds, rightIds]=internAll(leftLines, rightLines)
+    changes=[]
+    i=0
+    j=0
+    for [mi, mj, size] in [*findMatches(leftIds, rightIds), (len(leftLines), len(rightLines), 0)]:
+        if(i<mi or j<mj):
+            changes.append((i, mi, j, mj))
+        i=mi+size
+        j=mj+size
+    # Changes separated by at most twice the context share a hunk
+    groups=[]
+    for change in changes:
+        if(groups and change[0]-groups[-1][-1][1]<=2*contextLines):
+            groups[-1].append(change)
+        else:
+            groups.append([change])
+    for group in groups:
+        leftStart=max(0, group[0][0]-contextLines)
+        rightStart=group[0][2]-(group[0][0]-leftStart)
+        leftEnd=min(len(leftLines), group[-1][1]+contextLines)
+        rightEnd=group[-1][3]+(leftEnd-group[-1][1])
+        body=[]
+        i=leftStart
+        for [i1, i2, j1, j2] in group:
+            formatContent(' ', ''.join(leftLines[i:i1]), body)
+            formatChange(''.join(leftLines[i1:i2]), ''.join(rightLines[j1:j2]), body)
+            i=i2
+        formatContent(' ', ''.join(leftLines[i:leftEnd]), body)
+        yield f'@@ -{hunkRange(leftStart, leftEnd-leftStart)} ({len(body)}) +{hunkRange(rightStart, rightEnd-rightStart)} @@\n'
+        yield from body
+
+def splitFileLines(text):
+    lines=text.split('\n')
+    last=lines.pop()
+    return [line+'\n' for line in lines]+([last] if last else [])
+
+def blobId(data):
+    # The abbreviated object name git gives the content
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()[:7]
+
+def fileMode(st):
+    return '100755' if st.st_mode & 0o111 else '100644'
+
+def readFile(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def diffFiles(job):
+    # Returns the file comparison for two files as a string, or an empty
+    # string if they are equal. Either path is None for a created or deleted
+    # file, and both names differ for a renamed file.
+    [leftPath, rightPath, leftName, rightName]=job
+    leftStat=os.stat(leftPath) if leftPath else None
+    rightStat=os.stat(rightPath) if rightPath else None
+    if(leftStat and rightStat and os.path.samestat(leftStat, rightStat) and leftName==rightName):
+        return ''
+    left=readFile(leftPath) if leftPath else b''
+    right=readFile(rightPath) if rightPath else b''
+    if(left==right and leftName==rightName and leftPath and rightPath):
+        return ''
+    out=[f'diff --hintful a/{leftName} b/{rightName}\n']
+    if(leftName!=rightName and left==right):
+        out.append('similarity index 100%\n')
+        out.append(f'rename from {leftName}\n')
+        out.append(f'rename to {rightName}\n')
+        return ''.join(out)
+    if not leftPath:
+        out.append(f'new file mode {fileMode(rightStat)}\n')
+        out.append(f'index 0000000..{blobId(right)}\n')
+    elif not rightPath:
+        out.append(f'deleted file mode {fileMode(leftStat)}\n')
+        out.append(f'index {blobId(left)}..0000000\n')
+    elif(fileMode(leftStat)==fileMode(rightStat)):
+        out.append(f'index {blobId(left)}..{blobId(right)} {fileMode(leftStat)}\n')
+    else:
+        out.append(f'index {blobId(left)}..{blobId(right)}\n')
+    if(left or right):
+        out.append(f'--- a/{leftName}\n' if leftPath else '--- /dev/null\n')
+        out.append(f'+++ b/{rightName}\n' if rightPath else '+++ /dev/null\n')
+        out.extend(formatHunks(splitFileLines(left.decode('latin1')), splitFileLines(right.decode('latin1'))))
+    return ''.join(out)
+
+def pathName(path):
+    # File names are written as their bytes, like content
+    return os.fsencode(path).decode('latin1')
+
+def listFiles(root):
+    # Maps the name of each file below root, relative to root, to its path
+    files={}
+    for [dirPath, dirNames, fileNames] in os.walk(root):
+        for fileName in fileNames:
+            path=os.path.join(dirPath, fileName)
+            files[pathName(os.path.relpath(path, root).replace(os.sep, '/'))]=path
+    return files
+
+def diffJobs(left, right, jobs):
+    if(os.path.isdir(left)!=os.path.isdir(right)):
+        raise ValueError("Cannot compare a file with a directory")
+    if(os.path.isdir(left)):
+        if(1<jobs):
+            with multiprocessing.pool.ThreadPool(2) as pool:
+                [leftFiles, rightFiles]=pool.map(listFiles, [left, right])
+        else:
+            [leftFiles, rightFiles]=[listFiles(left), listFiles(right)]
+    else:
+        [leftFiles, rightFiles]=[{pathName(os.path.basename(left)): left}, {pathName(os.path.basename(right)): right}]
+    for name in [*leftFiles, *rightFiles]:
+        if(re.search(r'\s', name)):
+            raise ValueError(f"Cannot diff {name}: File names in diffs cannot contain whitespace")
+    # A removed file and an added file with the same content are a rename
+    removed=[name for name in leftFiles if name not in rightFiles]
+    added=[name for name in rightFiles if name not in leftFiles]
+    renames={}
+    renamedTo=set()
+    if(removed and added):
+        addedBySize={}
+        for name in added:
+            addedBySize.setdefault(os.path.getsize(rightFiles[name]), []).append(name)
+        addedByContent={}
+        for name in removed:
+            for candidate in addedBySize.get(os.path.getsize(leftFiles[name]), []):
+                if(candidate not in addedByContent):
+                    addedByContent[candidate]=readFile(rightFiles[candidate])
+            content=None
+            for candidate in addedBySize.get(os.path.getsize(leftFiles[name]), []):
+                if(candidate in renamedTo):
+                    continue
+                if(content is None):
+                    content=readFile(leftFiles[name])
+                if(addedByContent[candidate]==content):
+                    renames[name]=candidate
+                    renamedTo.add(candidate)
+                    break
+    names=sorted({*leftFiles, *rightFiles}-renamedTo, key=lambda name: renames.get(name, name))
+    for name in names:
+        rightName=renames.get(name, name)
+        yield (leftFiles.get(name), rightFiles.get(rightName), name, rightName)
+
+def generateDiff(left, right, jobs=1):
+    # Yields the diff of left and right, which are both files or both
+    # directories, one file comparison at a time
+    if(1<jobs):
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            yield from pool.imap(diffFiles, diffJobs(left, right, jobs), 16)
+    else:
+        yield from map(diffFiles, diffJobs(left, right, jobs))
+
+def diffMain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('left', help='file or directory on the left side')
+    parser.add_argument('right', help='file or directory on the right side')
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N', help='compare files in N processes')
+    args = parser.parse_args()
+    sys.stdout.reconfigure(encoding='latin1')
+    differ=[False]
+    def texts():
+        for text in generateDiff(args.left, args.right, args.jobs):
+            if text:
+                differ[0]=True
+                yield text
+    try:
+        output(texts())
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(2)
+    sys.exit(1 if differ[0] else 0)
+
+# Indexing, used by the index-diff and extract-diff commands. An index records
+# where each file comparison and hunk of a diff begins and ends, so that parts
+# of a large diff can be read without parsing the rest. It is a latin1 text file
+# with one space separated record per line:
+# - `hunk OFFSET END LINENR PREFIX HUNKTYPE LEFTSTART LEFTCOUNT RIGHTSTART RIGHTCOUNT`
+#   for each hunk, grouped by file comparison and in input order.
+# - `file OFFSET END LINENR PREFIX FILEFORMAT LEFTFILE RIGHTFILE HUNKSOFFSET HUNKCOUNT`
+#   for each file comparison, following all hunk records. HUNKSOFFSET is the
+#   position in the index of the first hunk record of the file comparison.
+# - `diff-index VERSION SIZE FILESOFFSET` as the last line, where SIZE is the
+#   size of the diff and FILESOFFSET the position of the first file record.
+# OFFSET and END are byte offsets into the diff, LINENR is the line number of
+# the header and PREFIX is `|` or `-` for no prefix. The file and hunk keys used
+# by the other stages are made of the file names and of the line ranges. Hunk
+# records are written as the diff is read, so that only file records are kept
+# in memory, and the last line tells where to find them.
+indexVersion = 1
+IndexedFile = namedtuple('IndexedFile', 'offset end lineNr prefix fileformat leftfile rightfile hunksoffset hunkcount')
+IndexedHunk = namedtuple('IndexedHunk', 'offset end lineNr prefix hunktype leftstartline leftlinecount rightstartline rightlinecount')
+indexedHeaderStarts = ('diff --', '|diff --', '@@', '|@@')
+
+def indexRecord(kind, record):
+    return ' '.join([kind, *['-' if field=='' else str(field) for field in record]])+'\n'
+
+def indexDiff(inputLines):
+    # Yields the index of the diff read from inputLines as strings. Hunk ends
+    # are only known when the next hunk or file comparison begins, so each hunk
+    # record is held back until then.
+    offsets={}
+    size=0
+    def lines():
+        nonlocal size
+        for lineNr, line in enumerate(inputLines, 1):
+            if(line.startswith(indexedHeaderStarts)):
+                offsets[lineNr]=size
+            size+=len(line)
+            yield line
+    position=0
+    files=[]
+    file=None
+    hunk=None
+    for obj in parseDiff(glueNonewline(lines())):
+        op=obj.op
+        if(op=='beginfile'):
+            file=IndexedFile(offsets.pop(obj.lineNr), None, obj.lineNr, obj.prefix, obj.fileformat, obj.leftfile, obj.rightfile, position, 0)
+        elif(op=='beginhunk'):
+            offset=offsets.pop(obj.lineNr)
+            if hunk:
+                text=indexRecord('hunk', hunk._replace(end=offset))
+                position+=len(text)
+                yield text
+            hunk=IndexedHunk(offset, None, obj.lineNr, obj.prefix, obj.hunktype, obj.leftstartline, obj.leftlinecount, obj.rightstartline, obj.rightlinecount)
+            file=file._replace(hunkcount=file.hunkcount+1)
+        elif(op=='endfile'):
+            # The file comparison ends where the next one begins
+            end=offsets.get(obj.lineNr+1, size)
+            if hunk:
+                text=indexRecord('hunk', hunk._replace(end=end))
+                position+=len(text)
+                yield text
+                hunk=None
+            files.append(file._replace(end=end))
+    for file in files:
+        yield indexRecord('file', file)
+    yield f'diff-index {indexVersion} {size} {position}\n'
+
+def readIndexTrailer(f, indexPath):
+    f.seek(0, os.SEEK_END)
+    f.seek(max(0, f.tell()-256))
+    fields=f.read().decode('latin1').rstrip('\n').split('\n')[-1].split(' ')
+    if(len(fields)!=4 or fields[0]!='diff-index' or fields[1]!=str(indexVersion)):
+        raise ValueError(f"{indexPath} is not an index written by this version of index-diff")
+    return int(fields[2]), int(fields[3])
+
+indexedStrFields = {'fileformat', 'leftfile', 'rightfile', 'hunktype'}
+def readIndexRecords(f, recordType, count=None):
+    # Reads records of recordType from the current position of f, up to count
+    # of them or until a record of another kind is found
+    kind=recordType.__name__[len('Indexed'):].lower()
+    while count is None or 0<count:
+        line=f.readline().decode('latin1')
+        if not line.startswith(kind+' '):
+            break
+        fields=line[len(kind)+1:-1].split(' ')
+        yield recordType(*[
+            ('' if value=='-' else value) if name=='prefix' else value if name in indexedStrFields else int(value)
+            for name, value in zip(recordType._fields, fields)])
+        if count is not None:
+            count-=1
+
+def pathMatches(file, paths):
+    for name in [file.leftfile, file.rightfile]:
+        if(name in paths or name.partition('/')[2] in paths):
+            return True
+    return False
+
+def hunkInRange(hunk, first, last):
+    # Whether the hunk touches any of the lines first to last on the left side
+    return hunk.leftstartline<=last and first<=hunk.leftstartline+max(hunk.leftlinecount, 1)-1
+
+def extractRanges(indexFile, indexPath, diffSize, paths=None, lineRange=None):
+    # Yields the [start, end) byte ranges of the diff to extract. With a line
+    # range, only the headers of each file comparison and the hunks in the range
+    # are extracted, and file comparisons without such hunks are left out.
+    [indexedSize, filesOffset]=readIndexTrailer(indexFile, indexPath)
+    if(indexedSize!=diffSize):
+        raise ValueError(f"{indexPath} does not match the diff, which has changed since it was indexed")
+    indexFile.seek(filesOffset)
+    files=[file for file in readIndexRecords(indexFile, IndexedFile) if paths is None or pathMatches(file, paths)]
+    for file in files:
+        if(lineRange is None):
+            yield (file.offset, file.end)
+            continue
+        indexFile.seek(file.hunksoffset)
+        hunks=list(readIndexRecords(indexFile, IndexedHunk, file.hunkcount))
+        selected=[hunk for hunk in hunks if hunkInRange(hunk, *lineRange)]
+        if selected:
+            yield (file.offset, hunks[0].offset)
+            for hunk in selected:
+                yield (hunk.offset, hunk.end)
+
+def parseLineRange(text):
+    linem=re.fullmatch(r'([0-9]+)(-([0-9]+))?', text)
+    if not linem:
+        raise argparse.ArgumentTypeError(f"expected FIRST or FIRST-LAST, got {text}")
+    first=int(linem[1])
+    return (first, int(linem[3]) if linem[3] else first)
+
+def replaceFile(path, write):
+    # Calls write with a temporary file beside path, which is moved over path
+    # once it is complete, so that path is never seen half written
+    [fd, tempPath]=tempfile.mkstemp(prefix=f'.{os.path.basename(path)}-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with open(fd, 'wb') as out:
+            write(out)
+            # Like a file created with open(), rather than private to the user
+            umask=os.umask(0)
+            os.umask(umask)
+            os.fchmod(out.fileno(), 0o666 & ~umask)
+        os.replace(tempPath, path)
+    except BaseException:
+        os.unlink(tempPath)
+        raise
+
+def indexMain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?', help='read the diff from this file instead of from stdin')
+    parser.add_argument('--output', '-o', metavar='INDEX', help='write the index to this file instead of to FILE.index, or to stdout when reading from stdin')
+    args = parser.parse_args()
+    outputPath=args.output or (args.file and f'{args.file}.index')
+    try:
+        if not outputPath:
+            writeBlocks(indexDiff(getInputLines()), sys.stdout.buffer.write)
+            return
+        replaceFile(outputPath, lambda out: writeBlocks(indexDiff(getInputLines(args.file)), out.write))
+    except DiffFormatError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(1)
+    except (ImplementationError, OSError) as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(2)
+
+def extractMain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('diff', help='the indexed diff file')
+    parser.add_argument('--index', metavar='INDEX', help='read the index from this file instead of from DIFF.index')
+    parser.add_argument('--file', '-f', action='append', metavar='PATH', help='extract the file comparisons of PATH, with or without its first path component; can be given more than once')
+    parser.add_argument('--hunk-range', type=parseLineRange, metavar='FIRST[-LAST]', help='extract only the hunks touching these lines on the left side')
+    args = parser.parse_args()
+    indexPath=args.index or f'{args.diff}.index'
+    try:
+        with open(args.diff, 'rb') as f, open(indexPath, 'rb') as indexFile:
+            size=os.fstat(f.fileno()).st_size
+            ranges=list(extractRanges(indexFile, indexPath, size, set(args.file) if args.file else None, args.hunk_range))
+            if not ranges:
+                sys.stderr.write("No matching file comparisons\n")
+                sys.exit(1)
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for [start, end] in ranges:
+                    sys.stdout.buffer.write(view[start:end])
+                sys.stdout.buffer.flush()
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(2)
+
+# Statistics, used by the diffstat-diff command. The diff is parsed with
+# countOnly, so that hunk content is never built. Only unprefixed file
+# comparisons are counted, since prefixed ones are other versions of the same
+# changes, but the snippets of both versions are counted, since in compat format
+# only the prefixed version uses them.
+FileStat = namedtuple('FileStat', 'leftfile rightfile added removed hunks snippets created deleted renamed lineNr')
+def collectFileStats(inputObjs):
+    prefixedSnippets={}
+    fileStat=None
+    for obj in inputObjs:
+        op=obj.op
+        if(obj.prefix):
+            if(op=='hunkcount'):
+                prefixedSnippets.setdefault(obj.hunk.filekey, set()).update(obj.snippetnames)
+            continue
+        if(op=='beginfile'):
+            snippetnames=prefixedSnippets.pop(obj.filekey, set())
+            fileStat=FileStat(obj.leftfile, obj.rightfile, 0, 0, 0, 0, False, False, False, obj.lineNr)
+        elif(op=='hunkcount'):
+            snippetnames.update(obj.snippetnames)
+            fileStat=fileStat._replace(added=fileStat.added+obj.added, removed=fileStat.removed+obj.removed, hunks=fileStat.hunks+1)
+        elif(op=='labels'):
+            fileStat=fileStat._replace(created=fileStat.created or obj.left=='/dev/null', deleted=fileStat.deleted or obj.right=='/dev/null')
+        elif(op=='leftfilemode'):
+            fileStat=fileStat._replace(deleted=True)
+        elif(op=='rightfilemode'):
+            fileStat=fileStat._replace(created=True)
+        elif(op=='rename'):
+            fileStat=fileStat._replace(renamed=True)
+        elif(op=='endfile'):
+            yield fileStat._replace(snippets=len(snippetnames))
+            fileStat=None
+        elif(op in headerOps or op=='beginhunk'):
+            pass
+        else:
+            die(f'collectFileStats cannot process operation {op}', None)
+
+statCounts = ['added', 'removed', 'hunks', 'snippets', 'created', 'deleted', 'renamed']
+def statName(fileStat):
+    left=fileStat.leftfile.partition('/')[2] or fileStat.leftfile
+    right=fileStat.rightfile.partition('/')[2] or fileStat.rightfile
+    return right if left==right else f'{left} => {right}'
+
+def formatFileStats(fileStats):
+    # One tab separated line per file comparison with the added and removed
+    # lines, the hunks and the snippets, followed by a line with the totals
+    totals=dict.fromkeys(statCounts, 0)
+    files=0
+    for fileStat in fileStats:
+        files+=1
+        for name in statCounts:
+            totals[name]+=getattr(fileStat, name)
+        flags=[flag for flag in ['created', 'deleted', 'renamed'] if getattr(fileStat, flag)]
+        yield f"{fileStat.added}\t{fileStat.removed}\t{fileStat.hunks}\t{fileStat.snippets}\t{statName(fileStat)}{' ('+', '.join(flags)+')' if flags else ''}\n"
+    yield (f"{files} files, {totals['added']} lines added, {totals['removed']} lines removed, {totals['hunks']} hunks, "
+           f"{totals['snippets']} snippets, {totals['created']} created, {totals['deleted']} deleted, {totals['renamed']} renamed\n")
+
+def formatFileStatsJson(fileStats):
+    # A JSON object with a list of file comparisons and the totals, written as
+    # the file comparisons come
+    totals=dict.fromkeys(statCounts, 0)
+    files=0
+    yield '{"files": ['
+    for fileStat in fileStats:
+        yield (',\n' if files else '\n')+json.dumps({
+            'left': fileStat.leftfile,
+            'right': fileStat.rightfile,
+            **{name: getattr(fileStat, name) for name in statCounts},
+        })
+        files+=1
+        for name in statCounts:
+            totals[name]+=getattr(fileStat, name)
+    yield '\n], "total": '+json.dumps({'files': files, **totals})+'}\n'
+
+def diffstatMain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?', help='read the diff from this file instead of from stdin')
+    parser.add_argument('--json', action='store_true', help='output JSON instead of text')
+    parser.add_argument('--include', action='append', metavar='GLOB', help='count only file comparisons of files matching GLOB; can be given more than once')
+    parser.add_argument('--exclude', action='append', metavar='GLOB', help='skip file comparisons of files matching GLOB; can be given more than once')
+    args = parser.parse_args()
+    sys.stdout.reconfigure(encoding='latin1')
+    events=parseDiff(glueNonewline(getInputLines(args.file)), fileSelector(args.include, args.exclude), countOnly=True)
+    try:
+        output((formatFileStatsJson if args.json else formatFileStats)(collectFileStats(events)))
+    except DiffFormatError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(1)
+    except ImplementationError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(2)
+
+def getProcStack(command=None):
     procStack={
+        'apply-compat-diff': [
+            assertNoUnprefixedHintfulFileComparisonsInCompat,
+            validateSnippets,
+            validateFilesAndHunks,
+            removeEverythingPrefixed,
+            applyDiff,
+        ],
+        'apply-hintful-diff': [
+            validateSnippets,
+            validateFilesAndHunks,
+            removeEverythingPrefixed,
+            applyDiff,
+        ],
+        'apply-unified-diff': [
+            assertNoUnprefixedHintfulFileComparisonsInUnified,
+            removeEverythingPrefixed,
+            validateFilesAndHunks,
+            applyDiff,
+        ],
         'convert-compat-diff-to-hintful-diff': [
-            groupHunks,
-            groupFiles,
             applyPrefixedFiles,
-            ungroupFiles,
-            ungroupHunks,
             formatDiff,
             output,
         ],
@@ -1152,17 +2527,17 @@ def getProcStack():
             output,
         ],
         'reverse-compat-diff': [
-            reverse,
+            reverseDiff,
             formatDiff,
             output,
         ],
         'reverse-hintful-diff': [
-            reverse,
+            reverseDiff,
             formatDiff,
             output,
         ],
         'reverse-unified-diff': [
-            reverse,
+            reverseDiff,
             formatDiff,
             output,
         ],
@@ -1191,19 +2566,759 @@ def getProcStack():
             terminalVisualize,
             output,
         ],
-    }[os.path.basename(sys.argv[0])]
+    }[command or os.path.basename(sys.argv[0])]
     return procStack
+
+# Library interface. Each function takes a diff as a str, as bytes or as a file
+# object opened in text or binary mode, and raises DiffFormatError if the diff
+# is invalid. Output is returned as bytes for bytes input, and as str otherwise.
+# No state is shared between calls, so they can be made from several threads.
+diffFormats = ['compat', 'hintful', 'unified']
+def linesOf(diff):
+    if(type(diff)==str):
+        return splitLines([diff])
+    elif(type(diff) in [bytes, bytearray, memoryview]):
+        return splitLines(decodeBlocks(memoryview(diff)))
+    else:
+        return splitLines(readBlocks(diff))
+
+def keepsLines(procStack):
+    # Whether `Content` events are worth keeping their input line in, see
+    # Content. Stages that collect hunks or files and yield them anew hold on
+    # to their content, and what they yield is formatted anew, so for them the
+    # lines would only double what is held.
+    return not any(stage in procStack for stage in [groupHunks, applyPrefixedFiles])
+
+def runStages(command, inputLines, highlight=False):
+    # Runs the processing stack of `command` except for its last stage, which
+    # is either output or sink, and returns the result along with that stage.
+    # formatDiff is resolved here rather than by looking at sys.stdout.
+    procStack=[(terminalHighlight if highlight else formatDiffRaw) if stage==formatDiff else stage for stage in getProcStack(command)]
+    def reducer(reduced, next_generator):
+        return next_generator(reduced)
+    parse=functools.partial(parseDiff, keepLines=keepsLines(procStack))
+    return functools.reduce(reducer, [glueNonewline, parse, *procStack[:-1]], inputLines), procStack[-1]
+
+def runCommand(command, diff):
+    result, lastStage=runStages(command, linesOf(diff))
+    if(lastStage==sink):
+        sink(result)
+        return None
+    text=''.join(result)
+    return text.encode('latin1') if type(diff) in [bytes, bytearray, memoryview] else text
+
+def checkFormat(diffFormat):
+    if(diffFormat not in diffFormats):
+        raise ValueError(f"Unknown diff format {diffFormat}, expected one of {', '.join(diffFormats)}")
+
+def parse(diff):
+    # Returns an iterator over the events of the diff, without validating it
+    # against any particular format.
+    return parseDiff(glueNonewline(linesOf(diff)))
+
+def validate(diff, diffFormat='hintful'):
+    checkFormat(diffFormat)
+    runCommand(f'validate-{diffFormat}-diff', diff)
+
+def convert(diff, srcFormat, dstFormat):
+    checkFormat(srcFormat)
+    checkFormat(dstFormat)
+    if(srcFormat==dstFormat):
+        raise ValueError(f"Cannot convert from {srcFormat} to {dstFormat}")
+    return runCommand(f'convert-{srcFormat}-diff-to-{dstFormat}-diff', diff)
+
+def reverse(diff, diffFormat='hintful'):
+    checkFormat(diffFormat)
+    return runCommand(f'reverse-{diffFormat}-diff', diff)
+
+def apply(diff, directory, diffFormat='hintful', check=False, jobs=1):
+    # Applies the diff to the files in directory. Raises DiffFormatError also
+    # if the diff does not apply, in which case nothing is changed.
+    checkFormat(diffFormat)
+    result, lastStage=runStages(f'apply-{diffFormat}-diff', linesOf(diff))
+    lastStage(result, directory, check, jobs)
+
+def diff(left, right, jobs=1):
+    # Returns a hintful diff of two files or two directories, given as paths,
+    # or an empty string if they are equal
+    return ''.join(generateDiff(left, right, jobs))
+
+def diffstat(diff):
+    # Returns a FileStat for each unprefixed file comparison
+    return list(collectFileStats(parseDiff(glueNonewline(linesOf(diff)), countOnly=True)))
+
+def highlight(diff):
+    return runCommand('terminal-highlight-diff', diff)
+
+def visualize(diff):
+    return runCommand('terminal-visualize-diff', diff)
+
+# Asyncio interface. The stages run in a worker thread, which reads blocks from
+# an asyncio.StreamReader through the event loop only as it needs them, and
+# hands what it produced to the event loop in batches, at least every
+# sliceSeconds. Parsing thus never runs on the event loop, and the worker gives
+# up the interpreter at the end of each slice so that the loop is not kept
+# waiting for it. The slice is only a target: the loop still shares the
+# interpreter with the worker while it runs, and a single event, e.g. of a huge
+# line, can take longer than a slice to produce. At most asyncQueueSize batches
+# are queued, so a slow consumer or writer holds up the worker and the reading,
+# rather than letting output pile up in memory.
+# Workers run on a pool of asyncWorkers threads of their own rather than on the
+# default executor of the loop, so that long parses do not hold up its other
+# users, like name resolution. Calls beyond that many wait for a free thread. A
+# caller can pass its own executor instead.
+asyncQueueSize=4
+asyncWorkers=4
+asyncExecutor=None
+asyncExecutorLock=threading.Lock()
+def defaultAsyncExecutor():
+    global asyncExecutor
+    with asyncExecutorLock:
+        if asyncExecutor is None:
+            import concurrent.futures
+            asyncExecutor=concurrent.futures.ThreadPoolExecutor(asyncWorkers, thread_name_prefix='hintful-diff')
+        return asyncExecutor
+
+async def runInWorker(reader, run, sliceSeconds=0.01, blockSize=1<<16, executor=None):
+    # Yields batches of what run(inputLines) yields
+    import asyncio # Takes longer to import than all else, and is rarely needed
+    loop=asyncio.get_running_loop()
+    queue=asyncio.Queue(asyncQueueSize)
+    closed=False
+    pendingReads=[]
+    async def put(item):
+        if not closed:
+            await queue.put(item)
+    def hand(item):
+        asyncio.run_coroutine_threadsafe(put(item), loop).result()
+    def blocks():
+        while True:
+            future=asyncio.run_coroutine_threadsafe(reader.read(blockSize), loop)
+            pendingReads[:]=[future]
+            block=future.result()
+            if not block:
+                return
+            yield block.decode('latin1') if type(block)==bytes else block
+    def work():
+        batch=[]
+        deadline=time.perf_counter()+sliceSeconds
+        try:
+            for item in run(splitLines(blocks())):
+                batch.append(item)
+                if(deadline<=time.perf_counter()):
+                    hand(batch)
+                    if closed:
+                        return
+                    batch=[]
+                    time.sleep(0)
+                    deadline=time.perf_counter()+sliceSeconds
+            hand(batch)
+            hand(None)
+        except BaseException as e:
+            hand(e)
+    worker=loop.run_in_executor(executor or defaultAsyncExecutor(), work)
+    try:
+        while True:
+            batch=await queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch
+        await worker
+    finally:
+        # If the consumer stopped early, let a worker waiting to hand over a
+        # batch or for a block go on to notice that it is no longer wanted
+        closed=True
+        for future in pendingReads:
+            future.cancel()
+        while not queue.empty():
+            queue.get_nowait()
+
+async def aparse(reader, sliceSeconds=0.01, blockSize=1<<16, executor=None):
+    # Like parse, as an async generator over the events of a diff read from an
+    # asyncio.StreamReader
+    async for batch in runInWorker(reader, lambda inputLines: parseDiff(glueNonewline(inputLines)), sliceSeconds, blockSize, executor):
+        for obj in batch:
+            yield obj
+
+async def aconvert(reader, writer, srcFormat, dstFormat, sliceSeconds=0.01, blockSize=1<<16, executor=None):
+    # Like convert, reading the diff from an asyncio.StreamReader and writing
+    # the result to an asyncio.StreamWriter. Like the commands, what was
+    # written before an error is kept.
+    checkFormat(srcFormat)
+    checkFormat(dstFormat)
+    if(srcFormat==dstFormat):
+        raise ValueError(f"Cannot convert from {srcFormat} to {dstFormat}")
+    command=f'convert-{srcFormat}-diff-to-{dstFormat}-diff'
+    async for texts in runInWorker(reader, lambda inputLines: runStages(command, inputLines)[0], sliceSeconds, blockSize, executor):
+        writer.write(''.join(texts).encode('latin1'))
+        await writer.drain()
+
+# Parallel mode, used with `--jobs N`. The input lines are split into ranges at
+# file comparison headers, and each range is run through the processing stack in
+# a pool of worker processes. File comparisons with the same file key, e.g. the
+# prefixed and unprefixed versions of a file, are kept in the same range, so the
+# only state that crosses ranges is the content of snippets, which is checked
+# here as the results come in.
+def splitFileComparisons(lines, minRangeSize):
+    # Returns [start, end) index ranges of at least minRangeSize lines, except
+    # for the last one
+    headers=[]
+    lastHeaderOf={}
+    for index, line in enumerate(lines):
+        if(line.startswith(fileHeaderStarts)):
+            linem=fileHeaderPattern.fullmatch(line)
+            if(linem):
+                key=(linem[3], linem[4])
+                lastHeaderOf[key]=len(headers)
+                headers.append((index, key))
+    ranges=[]
+    start=0
+    reach=0
+    for headerNr, (index, key) in enumerate(headers):
+        if(reach<headerNr and minRangeSize<=index-start):
+            ranges.append((start, index))
+            start=index
+        reach=max(reach, lastHeaderOf[key])
+    if(start<len(lines)):
+        ranges.append((start, len(lines)))
+    return ranges
+
+# Set before the worker processes are forked, so that they inherit it
+parallelJob=None
+def runRange(lineRange):
+    [start, end]=lineRange
+    [lines, parse, procStack]=parallelJob
+    snippetcache={}
+    procStack=[functools.partial(validateSnippets, snippetcache=snippetcache) if stage==validateSnippets else stage for stage in procStack]
+    def reducer(reduced, next_generator):
+        return next_generator(reduced)
+    result=functools.reduce(reducer, [functools.partial(glueNonewline, lineNr=start), parse, *procStack[:-1]], lines[start:end])
+    # Like output, keep what was produced before an error
+    texts=[]
+    try:
+        if(procStack[-1]==sink):
+            sink(result)
+        else:
+            texts.extend(result)
+        error=None
+    except (DiffFormatError, ImplementationError) as e:
+        error=e
+    return ''.join(texts), snippetcache, error
+
+def runParallel(procStack, inputLines, jobs, parse=parseDiff):
+    global parallelJob
+    lines=list(inputLines)
+    parallelJob=(lines, parse, procStack)
+    ranges=splitFileComparisons(lines, len(lines)//(jobs*8)+1)
+    def results():
+        snippetcache={}
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for text, rangeSnippets, error in pool.imap(runRange, ranges):
+                # Errors in later ranges are on later lines, so it is enough to
+                # compare the error of this range with snippet mismatches.
+                errors=[error] if error else []
+                for name, (digest, lineNr) in rangeSnippets.items():
+                    if(name not in snippetcache):
+                        snippetcache[name]=(digest, lineNr)
+                    elif(snippetcache[name][0]!=digest):
+                        errors.append(snippetMismatchError(name, lineNr))
+                if text:
+                    yield text
+                if errors:
+                    raise min(errors, key=lambda e: min(getattr(e, 'lineNrs', [0])))
+    procStack[-1](results())
+
+def pathMatchesGlob(path, pattern):
+    # Whether the path or one of its parent directories matches the pattern,
+    # so that e.g. both `vendor` and `vendor/` select everything in `vendor/`
+    parts=path.split('/')
+    pattern=pattern.rstrip('/')
+    return any(fnmatch.fnmatchcase('/'.join(parts[:i]), pattern) for i in range(1, len(parts)+1))
+
+def fileSelector(includes, excludes):
+    # Returns a selectFile function for parseDiff, or None to select all file
+    # comparisons. File names are matched without their first path component,
+    # like `patch -p1`, and a file comparison is selected if the name on either
+    # side is.
+    if not (includes or excludes):
+        return None
+    def selected(path):
+        return ((not includes or any(pathMatchesGlob(path, pattern) for pattern in includes)) and
+                not any(pathMatchesGlob(path, pattern) for pattern in excludes or []))
+    def selectFile(fileKey):
+        return any(selected(name.partition('/')[2] or name) for name in fileKey)
+    return selectFile
+
+# Batch mode, used with `--batch PATH...`. Each diff file given, and each
+# `.diff` or `.patch` file in the directories given, is processed on its own by
+# a pool of --jobs forked processes, which inherit the compiled patterns and
+# each take many files. Output is written beside each diff, or into the
+# --output-directory, under a name made by batchOutputName. For each diff, its
+# exit status and path are written to stdout and any error message to stderr,
+# and the exit status is the highest of them.
+batchExtensions=('.diff', '.patch')
+
+def batchInputs(paths):
+    # Returns each diff file with its name relative to the path it was found by
+    inputs=[]
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(batchExtensions):
+                        filePath=os.path.join(root, name)
+                        inputs.append((filePath, os.path.relpath(filePath, path)))
+        else:
+            inputs.append((path, os.path.basename(path)))
+    return inputs
+
+def batchOutputName(name, command):
+    # E.g. a.compat.diff becomes a.hintful.diff when converting from compat to
+    # hintful, a.patch becomes a.reversed.diff when reversing and a.highlight
+    # when highlighting
+    for extension in batchExtensions:
+        if name.endswith(extension):
+            name=name[:-len(extension)]
+            break
+    commandm=re.fullmatch(r'convert-(\w+)-diff-to-(\w+)-diff', command)
+    if commandm:
+        if name.endswith(f'.{commandm[1]}'):
+            name=name[:-len(commandm[1])-1]
+        return f'{name}.{commandm[2]}.diff'
+    if command.startswith('reverse-'):
+        return f'{name}.reversed.diff'
+    return f"{name}.{command.split('-')[1]}"
+
+# Set before the worker processes are forked, so that they inherit it
+batchJob=None
+def runBatchFile(paths):
+    [inputPath, outputPath]=paths
+    [parse, procStack]=batchJob
+    def reducer(reduced, next_generator):
+        return next_generator(reduced)
+    # The file is opened here rather than by getInputLines, which exits on
+    # errors, so that a file that cannot be read only fails on its own
+    try:
+        with open(inputPath, 'rb') as f:
+            result=functools.reduce(reducer, [glueNonewline, parse, *procStack[:-1]], splitLines(mapBlocks(f)))
+            if(procStack[-1]==sink):
+                sink(result)
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(outputPath)), exist_ok=True)
+                replaceFile(outputPath, lambda out: writeBlocks(result, out.write))
+        return 0, None
+    except DiffFormatError as e:
+        return 1, str(e)
+    except (ImplementationError, OSError) as e:
+        return 2, str(e)
+
+def runBatch(procStack, paths, outputDirectory, jobs, parse=parseDiff):
+    global batchJob
+    command=os.path.basename(sys.argv[0])
+    # Output goes to files, so it is never highlighted for a terminal
+    batchJob=(parse, [formatDiffRaw if stage==formatDiff else stage for stage in procStack])
+    files=[(path, os.path.join(outputDirectory, batchOutputName(name, command)) if outputDirectory else batchOutputName(path, command))
+           for [path, name] in batchInputs(paths)]
+    def report(results):
+        worst=0
+        try:
+            for [inputPath, __ignored], [status, message] in zip(files, results):
+                if message:
+                    sys.stderr.write(f"{inputPath}: {message}\n")
+                sys.stdout.write(f"{status}\t{inputPath}\n")
+                worst=max(worst, status)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # Like in output
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 1
+        return worst
+    if(1<jobs):
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            return report(pool.imap(runBatchFile, files, chunksize=max(1, min(64, len(files)//(jobs*8)))))
+    return report(map(runBatchFile, files))
+
+# Caching validation, enabled for the validate commands with `--cache FILE` or
+# the HINTFUL_DIFF_CACHE environment variable. The diff is split into file
+# comparisons at their headers, and each is looked up by a digest of its lines
+# together with the validating stages and the file selection. A file comparison
+# that passed the checks on its own is stored as the few events that the checks
+# across file comparisons look at, with hunk content reduced to digests and
+# line counts. On later runs these events are replayed instead of parsing the
+# file comparison again, so that only changed file comparisons are parsed and
+# checked on their own, while the checks across file comparisons always run.
+# The cache keeps the HINTFUL_DIFF_CACHE_ENTRIES most recently used file
+# comparisons, and is dropped when this file changes.
+cacheEntries=int(os.environ.get('HINTFUL_DIFF_CACHE_ENTRIES', 1<<16))
+
+class CachedEndHunk(namedtuple('CachedEndHunk', 'op prefix digests linecounts lineNr hunk')):
+    __slots__ = ()
+    hunkkey = EndHunk.hunkkey
+    def sideDigest(self, side):
+        return self.digests[side]
+    def sideLineCount(self, side):
+        return self.linecounts[side]
+
+def cacheVersion():
+    with open(__file__, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def loadCache(path, version):
+    # Returns the entries from least to most recently used. A missing, corrupt
+    # or outdated cache is empty.
+    try:
+        with open(path) as f:
+            cache=json.load(f)
+        if(cache['version']==version):
+            return dict(cache['entries'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+def saveCache(path, version, entries):
+    entries=list(entries.items())[-cacheEntries:] if 0<cacheEntries else []
+    replaceFile(path, lambda out: out.write(json.dumps({'version': version, 'entries': entries}, separators=(',', ':')).encode('latin1')))
+
+def fileSections(inputLines):
+    # Yields the lines of each file comparison, and of whatever precedes the
+    # first, with the number of lines before them and the first line of the next
+    # file comparison
+    lines=[]
+    before=0
+    for line in inputLines:
+        if(line.startswith(fileHeaderStarts) and lines):
+            yield before, lines, line
+            before+=len(lines)
+            lines=[]
+        lines.append(line)
+    if lines:
+        yield before, lines, None
+
+def summarizeEvent(obj, before):
+    # Returns what the checks across file comparisons look at of an event, with
+    # the line number relative to the start of its file comparison, or None
+    op=obj.op
+    lineNr=obj.lineNr-before
+    if(op=='beginfile'):
+        return [op, lineNr, obj.prefix, obj.fileformat, obj.leftfile, obj.rightfile, obj.crlf]
+    if(op=='endfile'):
+        return [op, lineNr, obj.prefix]
+    if(op=='index'):
+        return [op, lineNr, obj.prefix, obj.left, obj.right, obj.mode, obj.crlf]
+    if(op=='labels'):
+        return [op, lineNr, obj.prefix, obj.left, obj.right, obj.leftcrlf, obj.rightcrlf]
+    if(op=='beginhunk'):
+        # From leftstartlineraw to hunktype
+        return [op, lineNr, obj.prefix, obj.fileformat, *obj[5:17]]
+    if(op in ['endleftsnippet', 'endrightsnippet']):
+        return [op, lineNr, obj.prefix, obj.name, obj.digest.hex()]
+    if(op=='endhunk'):
+        return [op, lineNr, obj.prefix, *(value for side in ['left', 'right'] for value in [obj.sideDigest(side).hex(), *obj.sideLineCount(side)])]
+    return None
+
+def replayEvents(summary, before):
+    fileKey=None
+    hunk=None
+    for [op, lineNr, prefix, *values] in summary:
+        lineNr+=before
+        if(op=='beginfile'):
+            [fileFormat, leftFile, rightFile, crlf]=values
+            fileKey=(leftFile, rightFile)
+            yield BeginFile(op, prefix, fileKey, fileFormat, leftFile, rightFile, lineNr, crlf)
+        elif(op=='endfile'):
+            yield EndFile(op, prefix, fileKey, lineNr)
+        elif(op=='index'):
+            [left, right, mode, crlf]=values
+            yield Index(op, prefix, fileKey, left, right, mode, lineNr, crlf)
+        elif(op=='labels'):
+            [left, right, leftcrlf, rightcrlf]=values
+            yield Labels(op, prefix, fileKey, left, right, lineNr, leftcrlf, rightcrlf)
+        elif(op=='beginhunk'):
+            [fileFormat, *fields]=values
+            [leftstartline, rightstartline, leftlinecount, rightlinecount]=fields[6:10]
+            hunkKey=(fileKey, leftstartline, leftlinecount, rightstartline, rightlinecount)
+            hunk=BeginHunk(op, prefix, fileFormat, fileKey, hunkKey, *fields, lineNr)
+            yield hunk
+        elif(op=='endhunk'):
+            [leftDigest, leftLineCount, leftNonl, rightDigest, rightLineCount, rightNonl]=values
+            yield CachedEndHunk(op, prefix,
+                {'left': bytes.fromhex(leftDigest), 'right': bytes.fromhex(rightDigest)},
+                {'left': (leftLineCount, leftNonl), 'right': (rightLineCount, rightNonl)},
+                lineNr, hunk)
+        else:
+            [name, digest]=values
+            yield EndSnippet(op, prefix, name, bytes.fromhex(digest), lineNr, hunk)
+
+def parseCached(inputLines, parse, entries, stackKey):
+    # Used in place of glueNonewline and parse. The last stage must consume each
+    # event before the next is asked for, so that a file comparison is only
+    # stored once all of its events have passed the checks. A changed file
+    # comparison is parsed with the first line of the next one, so that it
+    # fails the same way as when parsed as part of the whole diff.
+    for [before, lines, nextHeader] in fileSections(inputLines):
+        digest=hashlib.blake2b(stackKey, digest_size=16)
+        digest.update(''.join(lines).encode('latin1'))
+        key=digest.hexdigest()
+        summary=entries.pop(key, None)
+        if summary is not None:
+            entries[key]=summary
+            yield from replayEvents(summary, before)
+            continue
+        summary=[]
+        lastLineNr=before+len(lines)
+        for obj in parse(glueNonewline([*lines, nextHeader] if nextHeader else lines, before)):
+            if(lastLineNr<obj.lineNr):
+                break
+            event=summarizeEvent(obj, before)
+            if event:
+                summary.append(event)
+            yield obj
+        entries[key]=summary
+
+# Profiling, enabled with `--profile REPORT` or the HINTFUL_DIFF_PROFILE
+# environment variable. Each stage of the processing stack is wrapped to count
+# the events it takes and yields and the time spent in it, not counting the
+# time spent in the stages before it. For stages that group events, the largest
+# number of events held in a single group is recorded as well. On exit, a report
+# is written to REPORT as JSON, or as text to stderr if REPORT is `-`. Without
+# profiling, the stages are run unwrapped.
+def groupedSize(obj):
+    if(obj.op=='hunk'):
+        return len(obj.contents)+2
+    if(obj.op=='file'):
+        return sum(groupedSize(contentObj) for contentObj in obj.contents)+2
+    return 0
+
+def stageName(stage):
+    return getattr(stage, 'func', stage).__name__
+
+def profileStages(fullProcStack, inputLines):
+    # Returns the wrapped stages and input, and the list of counters that the
+    # wrapped stages update, with one dict per stage and one for the input
+    clock=time.perf_counter
+    counters=[]
+    def counter(name):
+        stageCounters={'stage': name, 'eventsIn': 0, 'eventsOut': 0, 'seconds': 0.0, 'peakBuffered': None}
+        counters.append(stageCounters)
+        return stageCounters
+    def timed(iterator, stageCounters, grouping):
+        try:
+            while True:
+                start=clock()
+                try:
+                    obj=next(iterator)
+                finally:
+                    stageCounters['seconds']+=clock()-start
+                stageCounters['eventsOut']+=1
+                if grouping:
+                    stageCounters['peakBuffered']=max(stageCounters['peakBuffered'] or 0, groupedSize(obj))
+                yield obj
+        except StopIteration:
+            return
+    def counted(inputObjs, stageCounters):
+        for obj in inputObjs:
+            stageCounters['eventsIn']+=1
+            yield obj
+    def wrap(stage):
+        stageCounters=counter(stageName(stage))
+        grouping=stage in [groupHunks, groupFiles]
+        def profiled(inputObjs):
+            start=clock()
+            try:
+                result=stage(counted(inputObjs, stageCounters))
+            finally:
+                stageCounters['seconds']+=clock()-start
+            # The last stage consumes its input when called, and returns nothing
+            return None if result is None else timed(iter(result), stageCounters, grouping)
+        return profiled
+    inputCounters=counter('input')
+    return [wrap(stage) for stage in fullProcStack], timed(iter(inputLines), inputCounters, False), counters
+
+def writeProfile(report, counters, seconds):
+    # Times are inclusive of the stages before until here
+    previous=0.0
+    for stageCounters in counters:
+        [stageCounters['seconds'], previous]=[stageCounters['seconds']-previous, stageCounters['seconds']]
+    if(report=='-'):
+        lines=[f"{'stage':<40}{'events in':>12}{'events out':>12}{'seconds':>10}{'peak buffered':>15}\n"]
+        for stageCounters in counters:
+            lines.append(f"{stageCounters['stage']:<40}{stageCounters['eventsIn']:>12}{stageCounters['eventsOut']:>12}{stageCounters['seconds']:>10.3f}{stageCounters['peakBuffered'] or '':>15}\n")
+        lines.append(f"{'total':<40}{'':>12}{'':>12}{seconds:>10.3f}\n")
+        sys.stderr.write(''.join(lines))
+    else:
+        with open(report, 'w') as f:
+            json.dump({'command': os.path.basename(sys.argv[0]), 'seconds': seconds, 'stages': counters}, f, indent=1)
+            f.write('\n')
+
 def main(procStack):
-    # Abusing latin1 encoding lets us handle several encodings and also binary the same way
-    sys.stdin.reconfigure(encoding='latin1')
+    parser = argparse.ArgumentParser()
+    applying = procStack[-1]==applyDiff
+    validating = procStack[-1]==sink
+    if applying:
+        parser.add_argument('directory', help='apply the diff to the files in this directory')
+        parser.add_argument('--check', action='store_true', help='only check that the diff applies, without changing any file')
+    parser.add_argument('file', nargs='?', help='read the diff from this file instead of from stdin')
+    if applying:
+        parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N', help='patch files in N processes')
+    else:
+        parser.add_argument('--jobs', '-j', type=int, metavar='N', help='process file comparisons in N processes, which needs the whole diff in memory; with --batch, process diffs in N processes, by default one per CPU')
+        parser.add_argument('--batch', nargs='+', metavar='PATH', help='process each diff file PATH, and each .diff and .patch file in each directory PATH, on its own')
+        parser.add_argument('--output-directory', metavar='DIR', help='with --batch, write output into DIR instead of beside each diff')
+    parser.add_argument('--include', action='append', metavar='GLOB', help='process only file comparisons of files matching GLOB; can be given more than once')
+    parser.add_argument('--exclude', action='append', metavar='GLOB', help='skip file comparisons of files matching GLOB; can be given more than once')
+    if validating:
+        parser.add_argument('--cache', metavar='FILE', default=os.environ.get('HINTFUL_DIFF_CACHE'), help='keep the file comparisons that passed in FILE, and only check changed ones on their own')
+    parser.add_argument('--profile', metavar='REPORT', default=os.environ.get('HINTFUL_DIFF_PROFILE'), help='write the events and time of each stage to REPORT as JSON, or to stderr as text if REPORT is -')
+    args = parser.parse_args()
+    batch=not applying and args.batch
+    if(args.jobs is None):
+        args.jobs=os.cpu_count() if batch else 1
+    if(batch and args.file):
+        parser.error('FILE cannot be given with --batch')
+    if(batch and (args.profile or validating and args.cache)):
+        parser.error('--profile and --cache cannot be used with --batch')
+    if(args.profile and 1<args.jobs and not applying):
+        parser.error('--profile cannot be used with --jobs, since the stages run in other processes')
+    cachePath=validating and args.cache
+    if(cachePath and 1<args.jobs):
+        parser.error('--cache cannot be used with --jobs')
+    parse=functools.partial(parseDiff, selectFile=fileSelector(args.include, args.exclude), keepLines=keepsLines(procStack))
+    if applying:
+        procStack=[*procStack[:-1], functools.partial(applyDiff, directory=args.directory, check=args.check, jobs=args.jobs)]
     sys.stdout.reconfigure(encoding='latin1')
+    if batch:
+        sys.exit(runBatch(procStack, args.batch, args.output_directory, args.jobs, parse))
     def reducer(reduced, next_generator):
         return next_generator(reduced)
     fullProcStack=[
         glueNonewline,
-        parseDiff,
+        parse,
         *procStack,
     ]
-    functools.reduce(reducer, fullProcStack, getInputLines())
+    if cachePath:
+        cacheKey=json.dumps([[stageName(stage) for stage in procStack], args.include, args.exclude]).encode('latin1')
+        version=cacheVersion()
+        entries=loadCache(cachePath, version)
+        fullProcStack=[functools.partial(parseCached, parse=parse, entries=entries, stackKey=cacheKey), *procStack]
+    # Lines are taken in pieces where the diff is streamed through the stages
+    inputLines=getInputLines(args.file, pieces=not cachePath and (applying or args.jobs<=1))
+    if args.profile:
+        [fullProcStack, inputLines, counters]=profileStages(fullProcStack, inputLines)
+        start=time.perf_counter()
+    try:
+        if(1<args.jobs and not applying):
+            runParallel(procStack, inputLines, args.jobs, parse)
+        else:
+            functools.reduce(reducer, fullProcStack, inputLines)
+    except DiffFormatError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(1)
+    except ImplementationError as e:
+        sys.stderr.write(f"{e}\n")
+        sys.exit(2)
+    finally:
+        if args.profile:
+            writeProfile(args.profile, counters, time.perf_counter()-start)
+        if cachePath:
+            try:
+                saveCache(cachePath, version, entries)
+            except OSError as e:
+                sys.stderr.write(f"Could not write cache: {e}\n")
+
+# Server mode, started with `implementation.py --serve SOCKET`. Each client of
+# the Unix socket is served by a forked child, so that several diffs can be
+# processed at once without paying for interpreter startup and compilation.
+# A client first sends a line with a command name from getProcStack() and a 1
+# if its output goes to a terminal or a 0 otherwise, then the diff, and then
+# shuts down its sending side. The server replies with frames, each consisting
+# of a kind byte, a payload length as a 4-byte big-endian integer and the
+# payload. Kind b'o' is output, b'e' is an error message and b'x' is the exit
+# status in a single byte, which is always the last frame. See command.py for
+# the client.
+frameHeader = struct.Struct('>cI')
+def serveRequest(rfile, wfile):
+    def send(kind, data):
+        wfile.write(frameHeader.pack(kind, len(data)))
+        wfile.write(data)
+    try:
+        request=rfile.readline().decode('latin1').split()
+        if(len(request)!=2 or request[1] not in ['0', '1']):
+            die(f"Bad request {repr(request)}", None)
+        [command, isatty]=request
+        if(command.startswith('apply-')):
+            die(f"Command {command} needs the working directory of the client", None)
+        try:
+            result, lastStage=runStages(command, splitLines(readBlocks(rfile), pieces=True), isatty=='1')
+        except KeyError:
+            die(f"Unknown command {command}", None)
+        if(lastStage==sink):
+            sink(result)
+        else:
+            writeBlocks(result, lambda data: send(b'o', data))
+        status=0
+    except DiffFormatError as e:
+        send(b'e', f"{e}\n".encode('latin1'))
+        status=1
+    except ImplementationError as e:
+        send(b'e', f"{e}\n".encode('latin1'))
+        status=2
+    except BrokenPipeError:
+        return
+    except Exception:
+        send(b'e', traceback.format_exc().encode('latin1'))
+        status=2
+    send(b'x', bytes([status]))
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        serveRequest(self.rfile, self.wfile)
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+def serve(path):
+    if(os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode)):
+        # Take over the socket only if no other server is listening on it
+        with socket.socket(socket.AF_UNIX) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            else:
+                sys.stderr.write(f"A server is already listening on {path}\n")
+                sys.exit(2)
+    with Server(path, RequestHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+def serverMain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve', metavar='SOCKET', required=True, help='serve commands on this Unix socket')
+    args = parser.parse_args()
+    serve(args.serve)
+
+def commandMain(command):
+    if(command=='diff-hintful'):
+        diffMain()
+    elif(command=='index-diff'):
+        indexMain()
+    elif(command=='extract-diff'):
+        extractMain()
+    elif(command=='diffstat-diff'):
+        diffstatMain()
+    else:
+        main(getProcStack(command))
+
 if __name__ == "__main__":
-    main(getProcStack())
+    command=os.path.basename(sys.argv[0])
+    if(command=='implementation.py'):
+        serverMain()
+    else:
+        commandMain(command)